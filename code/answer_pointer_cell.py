@@ -5,20 +5,48 @@ import numpy as np
 class AnswerPointerCell(tf.contrib.rnn.RNNCell):
     """Answer Pointer Cell
     """
-    def __init__(self, state_size, encodings, encodings_mask, max_num_context_tokens):
+    def __init__(self, state_size, encodings, encodings_mask, max_num_context_tokens, precompute_attention = False, dtype = tf.float32):
         self.num_units = state_size
+
+        # RNNCell already has a read-only dtype property
+        self.float_dtype = dtype
         self.max_num_context_tokens = max_num_context_tokens
         self._state_size = tf.contrib.rnn.LSTMStateTuple(state_size, state_size)
         self._output_size = self.max_num_context_tokens
 
         self.encodings = encodings
         self.encodings_mask = encodings_mask
+
+        # When set, V * H is computed once per batch by precompute_encoding_projection() instead of at every step
+        self.precompute_attention = precompute_attention
+        self.encoding_projection = None
         
         self.initializer = tf.orthogonal_initializer()
             
         self.lstm_cell = tf.contrib.rnn.LSTMCell(num_units = state_size,
                                                  initializer = self.initializer)
 
+    def precompute_encoding_projection(self, scope = None):
+        """Computes V * H once for the whole batch.
+
+        The encodings don't change across the answer steps, so in the precomputed attention mode their
+        projection is computed here, before the recurrence.  This must be called before the cell is run.
+
+        Args:
+            scope: is the name of the scope to be used when defining V.
+        Returns:
+            the encoding projection of size [Batch Size x (P + 1) x L]
+        """
+        scope = scope or type(self).__name__ + 'Attention'
+
+        with tf.variable_scope(scope):
+            V = tf.get_variable(name = 'V', shape = [2 * self.num_units, self.num_units], dtype = self.float_dtype,
+                                initializer = tf.contrib.layers.xavier_initializer())
+
+            self.encoding_projection = tf.tensordot(self.encodings, V, axes = 1)                                                         # Dimensions = [Batch Size x (P + 1) x L]
+
+        return self.encoding_projection
+
     @property
     def state_size(self):
         return self._state_size
@@ -32,10 +60,9 @@ class AnswerPointerCell(tf.contrib.rnn.RNNCell):
 
         The cell equations are
 
-        G_t = tanh(W_q * H_q + (W_p * h_p_t + W_r * h_{t-1} + b_p))
-        a_t = softmax(w_a * G_t + b_a)
-        z_t = concat(h_p_t, H_q * a_t)
-        h_t = LSTM.call(input = z_t, state = h_{t-1})
+        F_k = tanh(V * H + (W * h_{k-1} + b))
+        beta_k = softmax(v * F_k + c)
+        h_k = LSTM.call(input = H * beta_k, state = h_{k-1})
 
         Args:
             inputs: is the input vector of size [None, self.input_size]
@@ -52,22 +79,34 @@ class AnswerPointerCell(tf.contrib.rnn.RNNCell):
             xavier_initializer = tf.contrib.layers.xavier_initializer()
             zeros_initializer = tf.zeros_initializer()
 
-            V = tf.get_variable(name = 'V', shape = [2 * self.num_units, self.num_units], dtype = tf.float64, initializer = xavier_initializer)
-            W = tf.get_variable(name = 'W', shape = [self.num_units, self.num_units], dtype = tf.float64, initializer = xavier_initializer)
-            b = tf.get_variable(name = 'b', shape = [1, self.num_units], dtype = tf.float64, initializer = zeros_initializer)
+            if not self.precompute_attention:
+                V = tf.get_variable(name = 'V', shape = [2 * self.num_units, self.num_units], dtype = self.float_dtype, initializer = xavier_initializer)
+            W = tf.get_variable(name = 'W', shape = [self.num_units, self.num_units], dtype = self.float_dtype, initializer = xavier_initializer)
+            b = tf.get_variable(name = 'b', shape = [1, self.num_units], dtype = self.float_dtype, initializer = zeros_initializer)
+            v = tf.get_variable(name = 'v', shape = [self.num_units, 1], dtype = self.float_dtype, initializer = xavier_initializer)
+            c = tf.get_variable(name = 'c', shape = [1,], dtype = self.float_dtype, initializer = zeros_initializer)
+
+            if self.precompute_attention:
+                # Only the W * h_{k-1} + b term changes between steps.  It is broadcasted over the precomputed encoding projection.
+                F_k = tf.tanh(self.encoding_projection + tf.expand_dims(tf.matmul(state.h, W) + b, 1))                                      # Dimensions = [Batch Size x (P + 1) x L]
 
-            H_ = tf.reshape(self.encodings, [-1, 2 * self.num_units])                                                                    # Dimensions = [Batch Size * (P + 1) x (2 * L)]
+                beta_k_ = tf.squeeze(tf.tensordot(F_k, v, axes = 1), [2]) + c                                                              # Dimensions = [Batch Size x (P + 1)]
+                beta_k_ = tf.add(beta_k_, self.encodings_mask)
+                beta_k = tf.nn.softmax(beta_k_)                                                                                               # Dimensions = [Batch Size x (P + 1)]
 
-            F_k = tf.tanh(tf.matmul(H_, V) + tf.reshape(tf.tile(tf.matmul(state.h, W) + b, [1, self.max_num_context_tokens]), [-1, self.num_units]))  # Dimensions = [Batch Size * (P + 1) x L]
+                weighted_encodings = tf.squeeze(tf.matmul(tf.expand_dims(beta_k, 1), self.encodings), [1])                                # Dimensions = [Batch Size X (2 * L)]
+            else:
+                H_ = tf.reshape(self.encodings, [-1, 2 * self.num_units])                                                                # Dimensions = [Batch Size * (P + 1) x (2 * L)]
 
-            v = tf.get_variable(name = 'v', shape = [self.num_units, 1], dtype = tf.float64, initializer = xavier_initializer)
-            c = tf.get_variable(name = 'c', shape = [1,], dtype = tf.float64, initializer = zeros_initializer)
-            beta_k_ = tf.matmul(F_k, v) + c                                                                                                   # Dimensions = [Batch Size * (P + 1) x 1]
-            beta_k_ = tf.reshape(beta_k_, [-1, self.max_num_context_tokens])                                                                  # Dimensions = [Batch Size x (P + 1)]
-            beta_k_ = tf.add(beta_k_, self.encodings_mask)
-            beta_k = tf.nn.softmax(beta_k_)                                                                                                   # Dimensions = [Batch Size x (P + 1)]
+                F_k = tf.tanh(tf.matmul(H_, V) + tf.reshape(tf.tile(tf.matmul(state.h, W) + b, [1, self.max_num_context_tokens]), [-1, self.num_units]))  # Dimensions = [Batch Size * (P + 1) x L]
+
+                beta_k_ = tf.matmul(F_k, v) + c                                                                                               # Dimensions = [Batch Size * (P + 1) x 1]
+                beta_k_ = tf.reshape(beta_k_, [-1, self.max_num_context_tokens])                                                              # Dimensions = [Batch Size x (P + 1)]
+                beta_k_ = tf.add(beta_k_, self.encodings_mask)
+                beta_k = tf.nn.softmax(beta_k_)                                                                                               # Dimensions = [Batch Size x (P + 1)]
+
+                weighted_encodings = tf.reduce_sum(tf.reshape(tf.multiply(H_, tf.reshape(beta_k, [-1, 1])), [-1, self.max_num_context_tokens, 2 * self.num_units]), 1)   # Dimensions = [Batch Size X (2 * L)]
 
-            weighted_encodings = tf.reduce_sum(tf.reshape(tf.multiply(H_, tf.reshape(beta_k, [-1, 1])), [-1, self.max_num_context_tokens, 2 * self.num_units]), 1)   # Dimensions = [Batch Size X (2 * L)]
             output, new_state = self.lstm_cell(weighted_encodings, state, scope = scope)
 
         return beta_k, new_state
@@ -84,27 +123,47 @@ def do_answer_pointer_cell_test():
             encodings_placeholder = tf.placeholder(tf.float64, shape=(None, 2, 2 * state_size))
             encodings_mask_placeholder = tf.placeholder(tf.float64, shape=(None, 2))
 
-            cell = AnswerPointerCell(state_size, encodings_placeholder, encodings_mask_placeholder, max_num_context_tokens)
+            cell = AnswerPointerCell(state_size, encodings_placeholder, encodings_mask_placeholder, max_num_context_tokens, dtype = tf.float64)
 
             probabilities, final_state = tf.nn.dynamic_rnn(cell = cell,
                                                            inputs = fake_inputs,
                                                            dtype = tf.float64,
                                                            scope = 'answer_pointer')
+
+            precomputed_cell = AnswerPointerCell(state_size, encodings_placeholder, encodings_mask_placeholder, max_num_context_tokens,
+                                                 precompute_attention = True, dtype = tf.float64)
+            precomputed_cell.precompute_encoding_projection(scope = 'answer_pointer_attention')
+
+            precomputed_probabilities, _ = tf.nn.dynamic_rnn(cell = precomputed_cell,
+                                                             inputs = fake_inputs,
+                                                             dtype = tf.float64,
+                                                             scope = 'answer_pointer_precomputed')
+
+            # Give the precomputed attention cell the same weights as the tiled one.  The variables are listed in
+            # creation order, and V is the first variable created by the tiled cell.
+            tiled_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope = 'test_answer_pointer_cell/answer_pointer/')
+            precomputed_variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope = 'test_answer_pointer_cell/answer_pointer_attention/') + \
+                                    tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope = 'test_answer_pointer_cell/answer_pointer_precomputed/')
+            copy_weights = [tf.assign(precomputed, tiled) for tiled, precomputed in zip(tiled_variables, precomputed_variables)]
             
             init = tf.global_variables_initializer()
             with tf.Session() as session:
                 session.run(init)
+                session.run(copy_weights)
                 encodings = np.array([
                     [[0.4, 0.5, 0.6, 0.2, 0.5, 0.1], [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]],
                     [[0.3, -0.2, -0.1, 0.7, -0.3, -0.7], [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]]], dtype=np.float64)
                 encodings_mask = np.array([[0.0, -np.inf],
                                            [0.0, 0.0]],
                                           dtype = np.float64)
-                probabilities, final_state = session.run([probabilities, final_state], feed_dict={encodings_placeholder: encodings,
-                                                                                                  encodings_mask_placeholder: encodings_mask})
+                probabilities, final_state, precomputed_probabilities = session.run([probabilities, final_state, precomputed_probabilities],
+                                                                                    feed_dict={encodings_placeholder: encodings,
+                                                                                               encodings_mask_placeholder: encodings_mask})
                 print("probabilities = " + str(probabilities))
                 print("final_state = " + str(final_state))
 
+                assert np.allclose(probabilities, precomputed_probabilities), "precomputed attention should match the tiled attention."
+
 
 if __name__ == "__main__":
     do_answer_pointer_cell_test()
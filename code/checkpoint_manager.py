@@ -0,0 +1,228 @@
+"""Checkpoints of the training, written without stalling it.
+
+CheckpointManager.save only copies the variables of the model to memory; a background thread then writes the
+copy to disk with its own tf.train.Saver, so the training goes on while the files are written.  The checkpoint
+paths are saved relative to the training directory, so the directory can be moved (e.g. to CodaLab) and still be
+restored from, without a global symlink.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from six.moves import queue
+import tensorflow as tf
+
+
+def latest_checkpoint(train_dir):
+    """Returns the path of the last checkpoint of train_dir, or None if there is none.
+
+    The checkpoints written before the paths were saved relative to train_dir point to another directory (the
+    /tmp/cs224n-squad-train symlink), then their files are looked up in train_dir.
+    """
+    ckpt = tf.train.get_checkpoint_state(train_dir) if train_dir else None
+    if not ckpt:
+        return None
+
+    for path in (ckpt.model_checkpoint_path, os.path.join(train_dir, os.path.basename(ckpt.model_checkpoint_path))):
+        if tf.gfile.Exists(path + ".index") or tf.gfile.Exists(path):
+            return path
+    return None
+
+
+BEST_SCORE_FILE = 'best_score.json'
+
+
+class CheckpointManager(object):
+    """Writes the checkpoints of a QASystem to train_dir in a background thread.
+
+    Only the keep last checkpoints are kept (all of them when keep is 0).  The checkpoint with the best score
+    (e.g. the validation F1) is also kept in best_dir (train_dir/best by default), which can be given to
+    qa_answer.py as its train_dir.  Its score is written next to it (in BEST_SCORE_FILE), so that a resumed
+    training only replaces it with a better one.
+
+    A snapshot holds a copy of all the variables of the model (with the optimizer slots and the global step, so
+    that the training can be resumed from it).  At most one snapshot waits while another one is being written, a
+    save only blocks when the writes fall further behind.
+    """
+    def __init__(self, model, train_dir, keep = 0, best_dir = None):
+        self.train_dir = train_dir
+        self.best_dir = best_dir or os.path.join(train_dir, 'best')
+        self.keep = keep
+
+        for directory in (self.train_dir, self.best_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        self.best_score = None
+        best_score_path = os.path.join(self.best_dir, BEST_SCORE_FILE)
+        if os.path.exists(best_score_path):
+            with open(best_score_path) as f:
+                self.best_score = json.load(f)['score']
+
+        with model.graph.as_default():
+            self.variables = tf.global_variables()
+        self.global_step = model.global_step
+
+        self.snapshots = queue.Queue(maxsize = 1)
+        self.error = None
+        self.writer = threading.Thread(target = self._write_snapshots)
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def save(self, session, score = None):
+        """
+        Snapshots the variables of session, to be written as the checkpoint of the current global step
+        :param score: (optional) the score of the model (higher is better), the checkpoint is also written to
+                      best_dir when it is the best so far
+        :return: whether it is the best checkpoint so far
+        """
+        self._raise_error()
+
+        step, values = session.run([self.global_step, self.variables])
+        # The fetched arrays can share the buffers of the variables, which the next training steps update
+        values = [np.copy(value) for value in values]
+
+        is_best = score is not None and (self.best_score is None or score > self.best_score)
+        if is_best:
+            self.best_score = score
+
+        self.snapshots.put((step, values, score if is_best else None))
+        return is_best
+
+
+    def _write_snapshots(self):
+        # A graph of the same variables, only loaded from the snapshots, so the model graph and its session are
+        # never touched by this thread
+        graph = tf.Graph()
+        with graph.as_default():
+            placeholders = [tf.placeholder(variable.dtype.base_dtype, shape = variable.get_shape()) for variable in self.variables]
+            copies = [tf.Variable(placeholder, trainable = False, collections = []) for placeholder in placeholders]
+            var_list = dict((variable.op.name, copy) for variable, copy in zip(self.variables, copies))
+
+            saver = tf.train.Saver(var_list, max_to_keep = self.keep, save_relative_paths = True)
+            best_saver = tf.train.Saver(var_list, max_to_keep = 1, save_relative_paths = True)
+
+        # Rotate the checkpoints of a resumed training too
+        for directory, directory_saver in ((self.train_dir, saver), (self.best_dir, best_saver)):
+            ckpt = tf.train.get_checkpoint_state(directory)
+            if ckpt:
+                directory_saver.recover_last_checkpoints(list(ckpt.all_model_checkpoint_paths))
+
+        with tf.Session(graph = graph) as session:
+            while True:
+                snapshot = self.snapshots.get()
+                if snapshot is None:
+                    return
+
+                step, values, best_score = snapshot
+                is_best = best_score is not None
+                try:
+                    session.run([copy.initializer for copy in copies], feed_dict = dict(zip(placeholders, values)))
+                    # The meta graph would be the one of this copy, not of the model
+                    path = saver.save(session, os.path.join(self.train_dir, 'model.ckpt'), global_step = step,
+                                      write_meta_graph = False)
+                    if is_best:
+                        best_saver.save(session, os.path.join(self.best_dir, 'model.ckpt'), global_step = step,
+                                        write_meta_graph = False)
+                        # Written after the checkpoint, so that it never claims a checkpoint that isn't there
+                        with open(os.path.join(self.best_dir, BEST_SCORE_FILE), 'w') as f:
+                            json.dump({'score': float(best_score), 'step': int(step)}, f)
+                    logging.info("Saved checkpoint %s%s" % (path, " (best)" if is_best else ""))
+                except Exception as e:
+                    self.error = e
+
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def close(self):
+        """Waits for the pending snapshots to be written."""
+        if self.writer.is_alive():
+            self.snapshots.put(None)
+            self.writer.join()
+        self._raise_error()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+def do_checkpoint_manager_test():
+    import shutil
+    import tempfile
+
+    from qa_model import InferenceEngine, get_test_qa_system
+
+    model = get_test_qa_system(max_context_length = 10, size = 4, optimizer = "sgd")
+
+    train_dir = tempfile.mkdtemp()
+    try:
+        with tf.Session(graph = model.graph) as session:
+            with model.graph.as_default():
+                session.run(tf.global_variables_initializer())
+
+            with CheckpointManager(model, train_dir, keep = 2) as checkpoints:
+                for step, score in enumerate([1.0, 3.0, 2.0]):
+                    session.run(model.global_step.assign(step))
+                    checkpoints.save(session, score)
+                    if step == 1:
+                        best_weights = model.get_weights(session)
+                    # Changes the weights while the snapshot may still be written
+                    model.set_weights(session, [weight + 1 for weight in model.get_weights(session)])
+                last_weights = model.get_weights(session)
+
+            kept = [os.path.basename(path) for path in tf.train.get_checkpoint_state(train_dir).all_model_checkpoint_paths]
+            assert kept == ['model.ckpt-1', 'model.ckpt-2'], "only the last 2 checkpoints should be kept."
+            with open(os.path.join(train_dir, 'checkpoint')) as f:
+                assert train_dir not in f.read(), "the checkpoint paths should be relative."
+
+            # The directories can be moved
+            moved_dir = train_dir + '_moved'
+            shutil.move(train_dir, moved_dir)
+            train_dir = moved_dir
+
+            model.saver.restore(session, latest_checkpoint(os.path.join(train_dir, 'best')))
+            assert all(np.array_equal(restored, best) for restored, best in zip(model.get_weights(session), best_weights))
+            assert session.run(model.global_step) == 1
+
+            model.saver.restore(session, latest_checkpoint(train_dir))
+            assert all(np.array_equal(restored + 1, last) for restored, last in zip(model.get_weights(session), last_weights))
+
+            # A resumed training only replaces the best checkpoint with a better one
+            with CheckpointManager(model, train_dir, keep = 2) as checkpoints:
+                assert checkpoints.best_score == 3.0
+                session.run(model.global_step.assign(3))
+                assert not checkpoints.save(session, 2.5)
+            assert os.path.basename(latest_checkpoint(os.path.join(train_dir, 'best'))) == 'model.ckpt-1', \
+                "a worse checkpoint of a resumed training shouldn't replace the best one."
+
+            with CheckpointManager(model, train_dir, keep = 2) as checkpoints:
+                session.run(model.global_step.assign(4))
+                assert checkpoints.save(session, 4.0)
+            assert os.path.basename(latest_checkpoint(os.path.join(train_dir, 'best'))) == 'model.ckpt-4'
+            assert not tf.gfile.Exists(os.path.join(train_dir, 'best', 'model.ckpt-1.index'))
+            best_weights = model.get_weights(session)
+
+        # The checkpoints of an sgd training restore into a model built with the default (adam) optimizer
+        inference_model = get_test_qa_system(max_context_length = 10, size = 4)
+        with InferenceEngine(inference_model, os.path.join(train_dir, 'best')) as engine:
+            assert all(np.array_equal(restored, best) for restored, best in zip(inference_model.get_weights(engine.session), best_weights))
+    finally:
+        shutil.rmtree(train_dir)
+
+    print("checkpoints = " + str(kept))
+
+
+if __name__ == "__main__":
+    do_checkpoint_manager_test()
@@ -1,3 +1,7 @@
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+
 def casing(word):
     if len(word) == 0: return word
 
@@ -15,3 +19,125 @@ def casing(word):
         
 
                     
+
+
+class MappedSequences(object):
+    """Read only, list like view of the sequences of a binary token ids file (see qa_data.data_to_binary).
+
+    The tokens are memory mapped, and indexing returns a slice of them, so nothing is parsed or copied
+    until a batch is padded.
+    """
+    def __init__(self, tokens, starts, ends):
+        self.tokens = tokens
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def load(cls, ids_path):
+        tokens = np.load(ids_path + '.tokens.npy', mmap_mode = 'r')
+        offsets = np.load(ids_path + '.offsets.npy')
+        return cls(tokens, offsets[:-1], offsets[1:])
+
+    def subset(self, indices):
+        return MappedSequences(self.tokens, self.starts[indices], self.ends[indices])
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.tokens[self.starts[i]:self.ends[i]]
+
+
+def flatten_sequences(sequences, dtype = np.int32):
+    """Concatenates the sequences into the (tokens, offsets) layout of the binary token ids files, where sequence
+    i is tokens[offsets[i]:offsets[i + 1]]."""
+    offsets = np.zeros(len(sequences) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+    tokens = np.empty(offsets[-1], dtype = dtype)
+    for i, sequence in enumerate(sequences):
+        tokens[offsets[i]:offsets[i + 1]] = sequence
+    return tokens, offsets
+
+
+def sequence_lengths(sequences):
+    if isinstance(sequences, MappedSequences):
+        return sequences.lengths()
+    return np.array([len(sequence) for sequence in sequences], dtype = np.int64)
+
+
+def pad_sequences(sequences, max_length = None):
+    """Pads a list of id sequences to the length of the longest one (after truncating them to max_length).
+
+    Returns the [Batch Size x T] padded int32 array and the [Batch Size] array of sequence lengths.
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype = np.int32)
+    if max_length is not None:
+        lengths = np.minimum(lengths, max_length)
+
+    padded = np.zeros((len(sequences), max(lengths.max(), 1)), dtype = np.int32)
+    for i, (sequence, length) in enumerate(zip(sequences, lengths)):
+        padded[i, :length] = sequence[:length]
+    return padded, lengths
+
+
+def answer_ids_from_spans(spans, context_lengths, max_answer_length, boundary_model = False):
+    """Converts [start, end] answer spans to the labels of the answer pointer.
+
+    For the boundary model these are the spans themselves.  For the sequence model, they are the answer token
+    indices followed by the end of answer token (index = context length), up to max_answer_length steps.
+    """
+    spans = np.asarray(spans, dtype = np.int32).reshape(-1, 2)
+    if boundary_model:
+        return spans
+
+    answer_ids = spans[:, 0:1] + np.arange(max_answer_length, dtype = np.int32)[None, :]
+    return np.where(answer_ids <= spans[:, 1:2], answer_ids, np.asarray(context_lengths, dtype = np.int32)[:, None])
+
+
+def make_batch(dataset, indices, max_question_length, max_context_length, max_answer_length, boundary_model = False):
+    """Builds the batch of the examples at indices, padded to its own longest question and context."""
+    question_ids, question_lengths = pad_sequences([dataset['question_ids'][i] for i in indices], max_question_length)
+    context_ids, context_lengths = pad_sequences([dataset['context_ids'][i] for i in indices], max_context_length)
+
+    batch = {'question_ids': question_ids,
+             'question_lengths': question_lengths,
+             'context_ids': context_ids,
+             'context_lengths': context_lengths}
+    if 'spans' in dataset:
+        batch['answer_ids'] = answer_ids_from_spans(np.asarray(dataset['spans'])[indices],
+                                                    context_lengths, max_answer_length, boundary_model)
+    return batch
+
+
+def bucketed_batch_indices(context_lengths, batch_size, shuffle = True, pool_size = 50):
+    """Returns the list of the example indices of every batch (see bucketed_batches)."""
+    num_examples = len(context_lengths)
+    indices = np.random.permutation(num_examples) if shuffle else np.arange(num_examples)
+
+    batches = []
+    pool_length = batch_size * pool_size
+    for pool_start in xrange(0, num_examples, pool_length):
+        pool = indices[pool_start:pool_start + pool_length]
+        pool = pool[np.argsort(context_lengths[pool], kind = 'mergesort')]
+        batches.extend(pool[batch_start:batch_start + batch_size] for batch_start in xrange(0, len(pool), batch_size))
+
+    if shuffle:
+        np.random.shuffle(batches)
+    return batches
+
+
+def bucketed_batches(dataset, batch_size, max_question_length, max_context_length, max_answer_length,
+                     boundary_model = False, shuffle = True, pool_size = 50):
+    """Yields the batches of the dataset, grouping examples of similar context lengths.
+
+    The examples are (optionally) shuffled and split in pools of pool_size batches.  Every pool is sorted by
+    context length before being cut into batches, and the order of the batches is shuffled again.  Each batch is
+    only padded to its own longest sequence, so the short contexts don't pay for the recurrent steps of the long
+    ones, while the batches still change from one epoch to the next.
+    """
+    context_lengths = np.minimum(sequence_lengths(dataset['context_ids']), max_context_length)
+    for batch_indices in bucketed_batch_indices(context_lengths, batch_size, shuffle, pool_size):
+        yield make_batch(dataset, batch_indices, max_question_length, max_context_length, max_answer_length, boundary_model)
@@ -6,6 +6,10 @@ import re
 import argparse
 import json
 import sys
+from itertools import islice
+from multiprocessing import Pool
+
+from preprocessing.json_stream import iter_records, iter_items
 
 
 def normalize_answer(s):
@@ -75,13 +79,166 @@ def evaluate(dataset, predictions):
     return {'exact_match': exact_match, 'f1': f1}
 
 
+# Fast path: the same metrics as above, with the regex and the punctuation table built once, and every prediction
+# and ground truth normalized once (instead of once per metric and per pair).
+ARTICLES_RE = re.compile(r'\b(a|an|the)\b')
+PUNCTUATION = frozenset(string.punctuation)
+PUNCTUATION_TABLE = dict((ord(ch), None) for ch in string.punctuation)
+
+
+def fast_normalize_answer(s):
+    """Same as normalize_answer."""
+    text = s.lower()
+    if isinstance(text, bytes):
+        text = ''.join(ch for ch in text if ch not in PUNCTUATION)
+    else:
+        text = text.translate(PUNCTUATION_TABLE)
+    return ' '.join(ARTICLES_RE.sub(' ', text).split())
+
+
+def score_answers(prediction, ground_truths):
+    """Returns the max over the ground truths of the exact match and of the f1 score of the prediction."""
+    prediction = fast_normalize_answer(prediction)
+    prediction_tokens = prediction.split()
+    prediction_counts = Counter(prediction_tokens)
+
+    exact_match = False
+    f1 = 0
+    for ground_truth in set(fast_normalize_answer(ground_truth) for ground_truth in ground_truths):
+        exact_match = exact_match or prediction == ground_truth
+
+        ground_truth_tokens = ground_truth.split()
+        num_same = sum((prediction_counts & Counter(ground_truth_tokens)).values())
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / len(prediction_tokens)
+        recall = 1.0 * num_same / len(ground_truth_tokens)
+        f1 = max(f1, (2 * precision * recall) / (precision + recall))
+    return exact_match, f1
+
+
+def score_answers_chunk(pairs):
+    """Scores the (prediction, ground truths) pairs, the unanswered questions (None pairs) get a score of 0."""
+    return [score_answers(*pair) if pair is not None else (False, 0) for pair in pairs]
+
+
+def fast_evaluate(dataset, predictions, num_workers=1, chunk_size=1000):
+    """Same as evaluate, optionally scoring the questions with a pool of num_workers processes.
+
+    The scores are still summed in the order of the questions, so the results are identical to evaluate's.
+    """
+    pairs = []
+    total = 0
+    for article in dataset:
+        for paragraph in article['paragraphs']:
+            for qa in paragraph['qas']:
+                total += 1
+                if qa['id'] not in predictions:
+                    message = 'Unanswered question ' + qa['id'] + \
+                              ' will receive score 0.'
+                    print(message, file=sys.stderr)
+                    continue
+                pairs.append((predictions[qa['id']], [answer['text'] for answer in qa['answers']]))
+
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    if num_workers > 1:
+        pool = Pool(num_workers)
+        try:
+            scores = pool.map(score_answers_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = [score_answers_chunk(chunk) for chunk in chunks]
+
+    f1 = exact_match = 0
+    for chunk_scores in scores:
+        for question_exact_match, question_f1 in chunk_scores:
+            exact_match += question_exact_match
+            f1 += question_f1
+
+    exact_match = 100.0 * exact_match / total
+    f1 = 100.0 * f1 / total
+
+    return {'exact_match': exact_match, 'f1': f1}
+
+
+def stream_evaluate(records, predictions, num_workers=1, chunk_size=1000):
+    """Same as evaluate, consuming the questions and the predictions as streams.
+
+    records yields the (article, paragraph, qa) of the questions (see preprocessing.json_stream.iter_records),
+    and predictions is either a dict or an iterable of (uuid, answer) pairs.  The prediction stream is only read
+    as far as the answer of the current question, and the answers read ahead of their question are kept until it
+    comes, so when the predictions are in the order of the questions, none of them stay in memory.
+    """
+    if isinstance(predictions, dict):
+        find_prediction = predictions.get
+    else:
+        pending = {}
+        predictions = iter(predictions)
+
+        def find_prediction(uuid):
+            while uuid not in pending:
+                item = next(predictions, None)
+                if item is None:
+                    return None
+                pending[item[0]] = item[1]
+            return pending.pop(uuid)
+
+    def iter_pairs():
+        for _, _, qa in records:
+            prediction = find_prediction(qa['id'])
+            if prediction is None:
+                message = 'Unanswered question ' + qa['id'] + \
+                          ' will receive score 0.'
+                print(message, file=sys.stderr)
+                yield None
+            else:
+                yield prediction, [answer['text'] for answer in qa['answers']]
+
+    pairs = iter_pairs()
+    chunks = iter(lambda: list(islice(pairs, chunk_size)), [])
+    pool = Pool(num_workers) if num_workers > 1 else None
+    try:
+        scores = pool.imap(score_answers_chunk, chunks) if pool else (score_answers_chunk(chunk) for chunk in chunks)
+
+        f1 = exact_match = total = 0
+        for chunk_scores in scores:
+            for question_exact_match, question_f1 in chunk_scores:
+                total += 1
+                exact_match += question_exact_match
+                f1 += question_f1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    exact_match = 100.0 * exact_match / total
+    f1 = 100.0 * f1 / total
+
+    return {'exact_match': exact_match, 'f1': f1}
+
+
 if __name__ == '__main__':
     expected_version = '1.1'
     parser = argparse.ArgumentParser(
         description='Evaluation for SQuAD ' + expected_version)
     parser.add_argument('dataset_file', help='Dataset file')
     parser.add_argument('prediction_file', help='Prediction File')
+    parser.add_argument('--num_workers', type=int, default=1, help='Number of processes scoring the answers')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the dataset and the predictions incrementally instead of loading them')
     args = parser.parse_args()
+    if args.stream:
+        top_level = {}
+        result = stream_evaluate(iter_records(args.dataset_file, top_level), iter_items(args.prediction_file),
+                                 num_workers=args.num_workers)
+        if (top_level.get('version') != expected_version):
+            print('Evaluation expects v-' + expected_version +
+                  ', but got dataset with v-' + str(top_level.get('version')),
+                  file=sys.stderr)
+        print(json.dumps(result))
+        sys.exit(0)
     with open(args.dataset_file) as dataset_file:
         dataset_json = json.load(dataset_file)
         if (dataset_json['version'] != expected_version):
@@ -91,4 +248,4 @@ if __name__ == '__main__':
         dataset = dataset_json['data']
     with open(args.prediction_file) as prediction_file:
         predictions = json.load(prediction_file)
-    print(json.dumps(evaluate(dataset, predictions)))
+    print(json.dumps(fast_evaluate(dataset, predictions, num_workers=args.num_workers)))
@@ -2,11 +2,51 @@ import tensorflow as tf
 import numpy as np
 
 
+def attention(question_projection, question_vector, question_mask, step_term, w_a, b_a):
+    """Returns the attention weighted questions H_q * a_t of a step of the cell.
+
+    Args:
+        question_projection: W_q * H_q, of size [Batch Size x Q x L]
+        question_vector: H_q, of size [Batch Size x Q x L]
+        question_mask: the additive softmax mask of the questions, of size [Batch Size x Q]
+        step_term: W_p * h_p_t + W_r * h_{t-1} + b_p, of size [Batch Size x L]
+    """
+    G_t = tf.tanh(question_projection + tf.expand_dims(step_term, 1))                                                                  # Dimensions = [Batch Size x Q x L]
+
+    a_t_ = tf.squeeze(tf.tensordot(G_t, w_a, axes = 1), [2]) + b_a                                                                    # Dimensions = [Batch Size x Q]
+    a_t_ = tf.add(a_t_, question_mask)
+    a_t = tf.nn.softmax(a_t_)                                                                                                          # Dimensions = [Batch Size x Q]
+
+    return tf.squeeze(tf.matmul(tf.expand_dims(a_t, 1), question_vector), [1])                                                       # Dimensions = [Batch Size X L]
+
+
+@tf.custom_gradient
+def recomputed_attention(question_projection, question_vector, question_mask, step_term, w_a, b_a):
+    """Same as attention, but its intermediates (G_t and a_t, of size [Batch Size x Q x L] and [Batch Size x Q]) are
+    computed again by the backward pass instead of being kept for it.
+
+    In a recurrence, the backward pass then only keeps the step term of every step (the other inputs don't depend
+    on the step), which trades one more attention computation per step for the memory of all the steps' G_t.
+    """
+    inputs = [question_projection, question_vector, question_mask, step_term, w_a, b_a]
+
+    def grad(weighted_questions_grad):
+        # A copy of the inputs, so that the gradients only go through the recomputed ops
+        recomputed_inputs = [tf.identity(x) for x in inputs]
+        return tf.gradients(attention(*recomputed_inputs), recomputed_inputs, grad_ys = weighted_questions_grad)
+
+    return attention(*inputs), grad
+
+
 class MatchLSTMCell(tf.contrib.rnn.RNNCell):
     """Match LSTM Cell
     """
-    def __init__(self, state_size, question_vector, question_mask, max_question_length, initializer = None):
+    def __init__(self, state_size, question_vector, question_mask, max_question_length, initializer = None, precompute_attention = False,
+                 recompute_attention = False, dtype = tf.float32):
         self.num_units = state_size
+
+        # RNNCell already has a read-only dtype property
+        self.float_dtype = dtype
         self._state_size = tf.contrib.rnn.LSTMStateTuple(state_size, state_size)
         self._output_size = state_size
 
@@ -14,6 +54,17 @@ class MatchLSTMCell(tf.contrib.rnn.RNNCell):
         self.question_mask = question_mask
         self.max_question_length = max_question_length
 
+        # When set, W_q * H_q is computed once per batch by precompute_question_projection() instead of at every step
+        self.precompute_attention = precompute_attention
+        self.question_projection = None
+
+        # When set, the attention intermediates of every step are computed again in the backward pass instead of
+        # being kept (see recomputed_attention).  It needs the precomputed question projection, so that the only
+        # input of the attention kept per step is the step term.
+        if recompute_attention and not precompute_attention:
+            raise ValueError("recompute_attention requires precompute_attention")
+        self.recompute_attention = recompute_attention
+
         if initializer:
             self.initializer = initializer
         else:
@@ -22,6 +73,28 @@ class MatchLSTMCell(tf.contrib.rnn.RNNCell):
         self.lstm_cell = tf.contrib.rnn.LSTMCell(num_units = state_size,
                                                  initializer = self.initializer)
 
+    def precompute_question_projection(self, scope = None):
+        """Computes W_q * H_q once for the whole batch.
+
+        The question projection doesn't depend on the timestep, so in the precomputed attention mode it is
+        computed here, outside of the recurrence, and every step only adds its own term to it.  This must be
+        called before the cell is run.
+
+        Args:
+            scope: is the name of the scope to be used when defining W_q.
+        Returns:
+            the question projection of size [Batch Size x Q x L]
+        """
+        scope = scope or type(self).__name__ + 'Attention'
+
+        with tf.variable_scope(scope):
+            W_q = tf.get_variable(name = 'W_q', shape = [self.num_units, self.num_units], dtype = self.float_dtype,
+                                  initializer = tf.contrib.layers.xavier_initializer())
+
+            self.question_projection = tf.tensordot(self.question_vector, W_q, axes = 1)                                                    # Dimensions = [Batch Size x Q x L]
+
+        return self.question_projection
+
     @property
     def state_size(self):
         return self._state_size
@@ -55,23 +128,32 @@ class MatchLSTMCell(tf.contrib.rnn.RNNCell):
             xavier_initializer = tf.contrib.layers.xavier_initializer()
             zeros_initializer = tf.zeros_initializer()
 
-            W_q = tf.get_variable(name = 'W_q', shape = [self.num_units, self.num_units], dtype = tf.float64, initializer = xavier_initializer)
-            W_p = tf.get_variable(name = 'W_p', shape = [self.num_units, self.num_units], dtype = tf.float64, initializer = xavier_initializer)
-            W_r = tf.get_variable(name = 'W_r', shape = [self.num_units, self.num_units], dtype = tf.float64, initializer = xavier_initializer)
-            b_p = tf.get_variable(name = 'b_p', shape = [1, self.num_units], dtype = tf.float64, initializer = zeros_initializer)
+            if not self.precompute_attention:
+                W_q = tf.get_variable(name = 'W_q', shape = [self.num_units, self.num_units], dtype = self.float_dtype, initializer = xavier_initializer)
+            W_p = tf.get_variable(name = 'W_p', shape = [self.num_units, self.num_units], dtype = self.float_dtype, initializer = xavier_initializer)
+            W_r = tf.get_variable(name = 'W_r', shape = [self.num_units, self.num_units], dtype = self.float_dtype, initializer = xavier_initializer)
+            b_p = tf.get_variable(name = 'b_p', shape = [1, self.num_units], dtype = self.float_dtype, initializer = zeros_initializer)
+            w_a = tf.get_variable(name = 'w_a', shape = [self.num_units, 1], dtype = self.float_dtype, initializer = xavier_initializer)
+            b_a = tf.get_variable(name = 'b_a', shape = [1,], dtype = self.float_dtype, initializer = zeros_initializer)
+
+            if self.precompute_attention:
+                # Only the step term depends on h_{t-1}.  It is broadcasted over the precomputed question projection.
+                step_term = tf.matmul(inputs, W_p) + tf.matmul(state.h, W_r) + b_p                                                          # Dimensions = [Batch Size x L]
+
+                attend = recomputed_attention if self.recompute_attention else attention
+                weighted_questions = attend(self.question_projection, self.question_vector, self.question_mask, step_term, w_a, b_a)        # Dimensions = [Batch Size X L]
+            else:
+                Q_ = tf.reshape(self.question_vector, [-1, self.num_units])                                                                    # Dimensions = [Batch Size * Q x L]
 
-            Q_ = tf.reshape(self.question_vector, [-1, self.num_units])                                                                        # Dimensions = [Batch Size * Q x L]
+                G_t = tf.tanh(tf.matmul(Q_, W_q) + tf.reshape(tf.tile(tf.matmul(inputs, W_p) + tf.matmul(state.h, W_r) + b_p, [1, self.max_question_length]), [-1, self.num_units]))   # Dimensions = [Batch Size * Q x L]
 
-            G_t = tf.tanh(tf.matmul(Q_, W_q) + tf.reshape(tf.tile(tf.matmul(inputs, W_p) + tf.matmul(state.h, W_r) + b_p, [1, self.max_question_length]), [-1, self.num_units]))   # Dimensions = [Batch Size * Q x L]
+                a_t_ = tf.matmul(G_t, w_a) + b_a                                                                                               # Dimensions = [Batch Size * Q x 1]
+                a_t_ = tf.reshape(a_t_, [-1, self.max_question_length])                                                                        # Dimensions = [Batch Size x Q]
+                a_t_ = tf.add(a_t_, self.question_mask)
+                a_t = tf.nn.softmax(a_t_)                                                                                                      # Dimensions = [Batch Size x Q]
 
-            w_a = tf.get_variable(name = 'w_a', shape = [self.num_units, 1], dtype = tf.float64, initializer = xavier_initializer)
-            b_a = tf.get_variable(name = 'b_a', shape = [1,], dtype = tf.float64, initializer = zeros_initializer)
-            a_t_ = tf.matmul(G_t, w_a) + b_a                                                                                                   # Dimensions = [Batch Size * Q x 1]
-            a_t_ = tf.reshape(a_t_, [-1, self.max_question_length])                                                                            # Dimensions = [Batch Size x Q]
-            a_t_ = tf.add(a_t_, self.question_mask)
-            a_t = tf.nn.softmax(a_t_)                                                                                                          # Dimensions = [Batch Size x Q]
+                weighted_questions = tf.reduce_sum(tf.reshape(tf.multiply(Q_, tf.reshape(a_t, [-1, 1])), [-1, self.max_question_length, self.num_units]), 1)   # Dimensions = [Batch Size X L]
 
-            weighted_questions = tf.reduce_sum(tf.reshape(tf.multiply(Q_, tf.reshape(a_t, [-1, 1])), [-1, self.max_question_length, self.num_units]), 1)   # Dimensions = [Batch Size X L]
             z_t = tf.concat([inputs, weighted_questions], 1)
             
             output, new_state = self.lstm_cell(z_t, state, scope = scope)
@@ -99,19 +181,36 @@ def do_match_lstm_cell_test():
             #    tf.get_variable("b_a", initializer=np.array(np.ones(1), dtype=np.float64))
 
             #tf.get_variable_scope().reuse_variables()
-            cell = MatchLSTMCell(state_size, state_size, H_q_placeholder, state_size, 2)
+            question_mask = tf.zeros_like(H_q_placeholder[:, :, 0])
+            cell = MatchLSTMCell(state_size, H_q_placeholder, question_mask, 2, dtype = tf.float64)
 
             outputs, final_state = tf.nn.dynamic_rnn(cell = cell,
                                                      sequence_length = seq_length_placeholder,
                                                      inputs = input_placeholder,
                                                      dtype = tf.float64,
                                                      scope = 'match_lstm')
+
+            precomputed_cell = MatchLSTMCell(state_size, H_q_placeholder, question_mask, 2, precompute_attention = True, dtype = tf.float64)
+            precomputed_cell.precompute_question_projection(scope = 'match_lstm_attention')
+
+            precomputed_outputs, _ = tf.nn.dynamic_rnn(cell = precomputed_cell,
+                                                       sequence_length = seq_length_placeholder,
+                                                       inputs = input_placeholder,
+                                                       dtype = tf.float64,
+                                                       scope = 'match_lstm_precomputed')
+
+            # Give the precomputed attention cell the same weights as the tiled one
+            variables = dict((v.op.name.split('/', 1)[1], v) for v in tf.global_variables())
+            copy_weights = [tf.assign(variables['match_lstm_attention/W_q'], variables['match_lstm/MatchLSTMCell/W_q'])]
+            copy_weights.extend(tf.assign(variable, variables[name.replace('match_lstm_precomputed/', 'match_lstm/')])
+                                for name, variable in variables.items() if name.startswith('match_lstm_precomputed/'))
             
             #y_var, ht_var = cell(x_placeholder, h_placeholder, scope="match_lstm")
 
             init = tf.global_variables_initializer()
             with tf.Session() as session:
                 session.run(init)
+                session.run(copy_weights)
                 lengths = np.array([1, 1], dtype=np.int32)
                 x = np.array([
                     [[0.4, 0.5, 0.6]],
@@ -126,17 +225,56 @@ def do_match_lstm_cell_test():
                                 [[0.7, -0.4, 0.2], [0.7, 0.5, 0.1]]])
                 ht = y
                 
-                outputs, final_state = session.run([outputs, final_state], feed_dict={seq_length_placeholder: lengths,
-                                                                                      input_placeholder: x,
-                                                                                      H_q_placeholder: H_q})
+                outputs, final_state, precomputed_outputs = session.run([outputs, final_state, precomputed_outputs],
+                                                                        feed_dict={seq_length_placeholder: lengths,
+                                                                                   input_placeholder: x,
+                                                                                   H_q_placeholder: H_q})
                 print("outputs = " + str(outputs))
                 print("final_state = " + str(final_state))
 
+                assert np.allclose(outputs, precomputed_outputs), "precomputed attention should match the tiled attention."
+
+
+def do_recompute_attention_test():
+    with tf.Graph().as_default():
+        state_size = 3
+        inputs = tf.constant(np.random.RandomState(0).randn(2, 4, state_size))
+        H_q = tf.constant(np.random.RandomState(1).randn(2, 2, state_size))
+        question_mask = tf.constant([[0.0, 0.0], [0.0, -1e30]], dtype = tf.float64)
+        lengths = tf.constant([4, 3])
+
+        def build(recompute_attention, scope):
+            with tf.variable_scope(scope):
+                cell = MatchLSTMCell(state_size, H_q, question_mask, 2, precompute_attention = True,
+                                     recompute_attention = recompute_attention, dtype = tf.float64)
+                cell.precompute_question_projection()
+                outputs, _ = tf.nn.dynamic_rnn(cell = cell, sequence_length = lengths, inputs = inputs, dtype = tf.float64)
+            variables = sorted(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope), key = lambda v: v.op.name)
+            loss = tf.reduce_sum(tf.square(outputs))
+            return outputs, tf.gradients(loss, [inputs, H_q] + variables), variables
+
+        outputs, gradients, variables = build(False, 'kept')
+        recomputed_outputs, recomputed_gradients, recomputed_variables = build(True, 'recomputed')
+        copy_weights = [tf.assign(recomputed, kept) for kept, recomputed in zip(variables, recomputed_variables)]
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            session.run(copy_weights)
+            outputs, gradients, recomputed_outputs, recomputed_gradients = session.run(
+                [outputs, gradients, recomputed_outputs, recomputed_gradients])
+
+    assert np.allclose(outputs, recomputed_outputs)
+    assert len(gradients) == len(recomputed_gradients)
+    assert all(np.allclose(kept, recomputed) for kept, recomputed in zip(gradients, recomputed_gradients)), \
+        "the recomputed attention should give the same gradients."
+    print("gradients = " + str(recomputed_gradients[0]))
+
                 #assert np.allclose(y_, ht_), "output and state should be equal."
                 #assert np.allclose(ht, ht_, atol=1e-2), "new state vector does not seem to be correct."
 
 
 if __name__ == "__main__":
     do_match_lstm_cell_test()
+    do_recompute_attention_test()
     
                                 
@@ -1,43 +1,164 @@
+"""NumPy (TensorFlow free) versions of the recurrent layers of the model, used by qa_model_np.
+
+They compute the same functions as tf.contrib.rnn.LSTMCell and MatchLSTMCell run by dynamic_rnn, batched over
+the examples.  The projections of the inputs are computed for all the time steps at once before the recurrence,
+so every step only multiplies its recurrent state.
+"""
 import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+# Same as utils.MASK_VALUE
+MASK_VALUE = -1e30
+
+# The default forget bias of tf.contrib.rnn.LSTMCell
+FORGET_BIAS = 1.0
+
+
+def sigmoid(x):
+    # Same as 1 / (1 + exp(-x)), without overflowing for large negative x
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+def softmax(x):
+    e = np.exp(x - np.max(x, axis = -1, keepdims = True))
+    return e / np.sum(e, axis = -1, keepdims = True)
+
+
+def softmax_mask(lengths, max_length, dtype):
+    """Same as utils.create_softmax_mask."""
+    masked = np.arange(max_length)[None, :] > np.asarray(lengths)[:, None]
+    return np.where(masked, MASK_VALUE, 0.0).astype(dtype)
+
+
+def reverse_sequences(sequences, lengths):
+    """Same as tf.reverse_sequence(sequences, lengths, seq_axis = 1, batch_axis = 0)."""
+    positions = np.arange(sequences.shape[1])[None, :]
+    lengths = np.asarray(lengths)[:, None]
+    indices = np.where(positions < lengths, lengths - 1 - positions, positions)
+    return sequences[np.arange(len(sequences))[:, None], indices]
+
+
+def lstm_step(projected_inputs, state, recurrent_kernel, bias):
+    """One step of tf.contrib.rnn.LSTMCell, given the projection of its inputs by their rows of the kernel.
+
+    Returns the new (c, h) state.
+    """
+    c, h = state
+    lstm_matrix = projected_inputs + np.dot(h, recurrent_kernel) + bias                                                  # Dimensions = [Batch Size x 4L]
+    i, j, f, o = np.split(lstm_matrix, 4, axis = 1)
+
+    c = sigmoid(f + FORGET_BIAS) * c + sigmoid(i) * np.tanh(j)
+    h = sigmoid(o) * np.tanh(c)
+    return c, h
+
+
+def _run(step, projected_inputs, lengths, num_units):
+    """Runs step(t, state) -> state over the sequences as dynamic_rnn does: the state is carried over unchanged
+    past the end of a sequence, where the outputs are zeros."""
+    batch_size, num_steps = projected_inputs.shape[:2]
+    dtype = projected_inputs.dtype
+    lengths = np.asarray(lengths)
+
+    state = (np.zeros((batch_size, num_units), dtype = dtype), np.zeros((batch_size, num_units), dtype = dtype))
+    outputs = np.zeros((batch_size, num_steps, num_units), dtype = dtype)
+    for t in xrange(min(num_steps, lengths.max() if len(lengths) else 0)):
+        new_c, new_h = step(t, state)
+        running = (t < lengths)[:, None]
+        state = (np.where(running, new_c, state[0]), np.where(running, new_h, state[1]))
+        outputs[:, t] = np.where(running, new_h, 0.0)
+    return outputs
+
+
+def dynamic_lstm(inputs, lengths, kernel, bias):
+    """Same as dynamic_rnn with an LSTMCell of this kernel and bias.
+
+    Args:
+        inputs: array of size [Batch Size x T x input size]
+        lengths: the lengths of the sequences, of size [Batch Size]
+    Returns:
+        the outputs of size [Batch Size x T x L]
+    """
+    input_size = inputs.shape[2]
+    num_units = kernel.shape[1] // 4
+
+    projected_inputs = np.dot(inputs, kernel[:input_size])                                                              # Dimensions = [Batch Size x T x 4L]
+    recurrent_kernel = kernel[input_size:]
+
+    def step(t, state):
+        return lstm_step(projected_inputs[:, t], state, recurrent_kernel, bias)
+
+    return _run(step, projected_inputs, lengths, num_units)
 
 
-def softmax(w):
-    e = np.exp(np.array(w))
-    dist = e / np.sum(e)
-    return dist
+def match_lstm(inputs, lengths, question_vector, question_mask, weights):
+    """Same as dynamic_rnn with a MatchLSTMCell (see its equations).
 
+    Args:
+        inputs: the context word encodings, of size [Batch Size x P x L]
+        lengths: the lengths of the contexts, of size [Batch Size]
+        question_vector: the question word encodings, of size [Batch Size x Q x L]
+        question_mask: the additive softmax mask of the questions, of size [Batch Size x Q]
+        weights: dict of the W_q, W_p, W_r, b_p, w_a, b_a weights and of the kernel and bias of the LSTM
+    Returns:
+        the outputs of size [Batch Size x P x L]
+    """
+    num_units = inputs.shape[2]
+    kernel = weights['kernel']
 
-H_q = \
-np.array([[[0.6, 0.3, -0.3], [0.7, 0.1, 0.3]],
-	  [[0.7, -0.4, 0.2], [0.7, 0.5, 0.1]]])
+    question_projection = np.dot(question_vector, weights['W_q'])                                                       # Dimensions = [Batch Size x Q x L]
+    projected_inputs = np.dot(inputs, weights['W_p']) + weights['b_p']                                                  # Dimensions = [Batch Size x P x L]
 
+    # z_t = concat(h_p_t, H_q * a_t), so the LSTM kernel rows are the ones of h_p_t, then of H_q * a_t, then of h_{t-1}
+    projected_lstm_inputs = np.dot(inputs, kernel[:num_units])                                                          # Dimensions = [Batch Size x P x 4L]
+    question_kernel = kernel[num_units:2 * num_units]
+    recurrent_kernel = kernel[2 * num_units:]
+    w_a = weights['w_a'][:, 0]
 
-X = \
-np.array([[0.4, 0.5, 0.6],
-	  [0.3, -0.2, -0.1]])
+    def step(t, state):
+        G_t = np.tanh(question_projection + (projected_inputs[:, t] + np.dot(state[1], weights['W_r']))[:, None, :])  # Dimensions = [Batch Size x Q x L]
+        a_t = softmax(np.dot(G_t, w_a) + weights['b_a'] + question_mask)                                                # Dimensions = [Batch Size x Q]
+        weighted_questions = np.matmul(a_t[:, None, :], question_vector)[:, 0]                                          # Dimensions = [Batch Size x L]
 
+        return lstm_step(projected_lstm_inputs[:, t] + np.dot(weighted_questions, question_kernel), state,
+                         recurrent_kernel, weights['bias'])
 
-h = \
-np.array([[0.2, 0.5, 0.7],
-	  [-0.3, -0.3, -0.3]])
+    return _run(step, projected_lstm_inputs, lengths, num_units)
 
 
-vocab_dim = 3
-q_len = 2
+def do_match_lstm_test():
+    """Checks the vectorized step against the cell equations written out for every example."""
+    np.random.seed(0)
+    batch_size, num_question_tokens, num_context_tokens, num_units = 2, 3, 4, 5
+    weights = {'W_q': np.random.randn(num_units, num_units),
+               'W_p': np.random.randn(num_units, num_units),
+               'W_r': np.random.randn(num_units, num_units),
+               'b_p': np.random.randn(1, num_units),
+               'w_a': np.random.randn(num_units, 1),
+               'b_a': np.random.randn(1),
+               'kernel': np.random.randn(3 * num_units, 4 * num_units),
+               'bias': np.random.randn(4 * num_units)}
+    inputs = np.random.randn(batch_size, num_context_tokens, num_units)
+    question_vector = np.random.randn(batch_size, num_question_tokens, num_units)
+    lengths = np.array([4, 2])
+    question_mask = softmax_mask([2, 1], num_question_tokens, np.float64)
 
-W_q=np.array(np.eye(vocab_dim, vocab_dim))
-W_p=np.array(np.eye(vocab_dim, vocab_dim))
-W_r=np.array(np.eye(vocab_dim, vocab_dim))
-b_p=np.array(np.ones(vocab_dim))
-w_a=np.array(np.eye(vocab_dim,1))
-b_a=np.array(np.ones(1))
+    outputs = match_lstm(inputs, lengths, question_vector, question_mask, weights)
 
+    for b in range(batch_size):
+        c = h = np.zeros(num_units)
+        for t in range(lengths[b]):
+            G = np.tanh(np.dot(question_vector[b], weights['W_q']) + np.dot(inputs[b, t], weights['W_p']) +
+                        np.dot(h, weights['W_r']) + weights['b_p'][0])
+            a = softmax(np.dot(G, weights['w_a'])[:, 0] + weights['b_a'] + question_mask[b])
+            z = np.concatenate([inputs[b, t], np.dot(a, question_vector[b])])
+            i, j, f, o = np.split(np.dot(np.concatenate([z, h]), weights['kernel']) + weights['bias'], 4)
+            c = sigmoid(f + FORGET_BIAS) * c + sigmoid(i) * np.tanh(j)
+            h = sigmoid(o) * np.tanh(c)
+            assert np.allclose(outputs[b, t], h)
+        assert np.all(outputs[b, lengths[b]:] == 0), "the outputs past the end of a sequence should be zeros."
 
-G = np.tanh(H_q_ + np.reshape(np.tile(X + h + b_p, [1, 2]), [-1, vocab_dim]))
-a_t_ = np.reshape(np.matmul(G, w_a) + b_a, [-1, q_len, 1])
-a_t = np.array([softmax(a_t_[0]), softmax(a_t_[1])])
+    print("outputs = " + str(outputs))
 
-H_q_a = np.sum(H_q * a_t, 1)
 
-h_r = np.concatenate((H_q_a, X), axis = 1)
-print h_r
+if __name__ == "__main__":
+    do_match_lstm_test()
@@ -0,0 +1,222 @@
+"""Synchronous data-parallel training of a QASystem over several local worker processes.
+
+Every worker holds a copy of the model and computes the gradients of the batches of its shard of the dataset.  The
+training process acts as the parameter server: at every step it sends its weights to the workers, averages the
+gradients they return (weighted by their batch sizes), and applies the average with the optimizer of its own model,
+which is clipped as in QASystem.optimize.  One step is therefore the same update as one batch of all the examples of
+the workers, while the forward and backward passes run in parallel on all the cores.
+"""
+import logging
+import multiprocessing
+import time
+import traceback
+
+import numpy as np
+from six.moves import cPickle as pickle
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+import data_util
+
+
+def run_worker(worker_id, num_workers, build_model, dataset, batch_size, connection, seed, num_threads):
+    """The loop of a worker process, answering the messages of DataParallelTrainer:
+
+    ('epoch',): starts a new (shuffled) pass over the shard
+    ('step', weights): replies with (batch size, loss, gradients) of the next batch for these weights, or None at
+                       the end of the shard
+    ('stop',): exits
+    """
+    # The forked workers would otherwise all shuffle their shards in the same order
+    np.random.seed(None if seed is None else seed + worker_id)
+
+    try:
+        model = build_model()
+        config = tf.ConfigProto(intra_op_parallelism_threads = num_threads, inter_op_parallelism_threads = num_threads)
+        with tf.Session(graph = model.graph, config = config) as session:
+            with model.graph.as_default():
+                session.run(tf.global_variables_initializer())
+
+            shard = np.arange(worker_id, len(dataset['spans']), num_workers)
+            context_lengths = np.minimum(data_util.sequence_lengths(dataset['context_ids'])[shard], model.context_max_length)
+            batches = iter(())
+
+            while True:
+                message = pickle.loads(connection.recv_bytes())
+                if message[0] == 'epoch':
+                    batches = iter(data_util.bucketed_batch_indices(context_lengths, batch_size))
+                elif message[0] == 'step':
+                    batch_indices = next(batches, None)
+                    if batch_indices is None:
+                        connection.send(('result', None))
+                        continue
+
+                    model.set_weights(session, message[1])
+                    batch = data_util.make_batch(dataset, shard[batch_indices],
+                                                 model.question_max_length,
+                                                 model.context_max_length,
+                                                 model.max_answer_length,
+                                                 boundary_model = model.decoder.boundary_model)
+                    loss, gradients = model.compute_gradients(session, batch)
+                    connection.send(('result', (len(batch_indices), loss, gradients)))
+                else:
+                    break
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class DataParallelTrainer(object):
+    """Runs the training epochs of a QASystem over num_workers processes (see QASystem.train).
+
+    The workers are forked when the trainer is created, so it must be created before any tf.Session of this
+    process.  build_model is called in every worker to build its copy of the model, it must build the same model as
+    the one trained.  Each worker gets its shard of the dataset (every num_workers-th example) and batches of
+    batch_size / num_workers examples, so a step is still a batch of about batch_size examples.
+    """
+    def __init__(self, build_model, dataset, num_workers, batch_size, seed = None):
+        num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+        worker_batch_size = max(1, batch_size // num_workers)
+
+        self.connections = []
+        self.workers = []
+        for worker_id in xrange(num_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target = run_worker,
+                                             args = (worker_id, num_workers, build_model, dataset, worker_batch_size,
+                                                     worker_connection, seed, num_threads))
+            worker.daemon = True
+            worker.start()
+            # So that recv fails instead of blocking when the worker dies
+            worker_connection.close()
+
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+
+    def _broadcast(self, connections, message):
+        # Pickled once for all the workers (the weights are the bulk of the messages)
+        message = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        for connection in connections:
+            try:
+                connection.send_bytes(message)
+            except (IOError, OSError):
+                # The worker has exited, the error it sent (if any) is raised by the next _receive
+                pass
+
+
+    def _receive(self, connection):
+        kind, result = connection.recv()
+        if kind == 'error':
+            raise RuntimeError("A training worker failed:\n" + result)
+        return result
+
+
+    def run_epoch(self, session, model, print_every = 1):
+        """
+        Runs one pass over the shards of all the workers, updating the model of session at every step
+        :return: the average loss of the epoch
+        """
+        total_loss = 0.
+        num_batches = 0
+        tic = time.time()
+
+        self._broadcast(self.connections, ('epoch',))
+        active_connections = list(self.connections)
+        while active_connections:
+            self._broadcast(active_connections, ('step', model.get_weights(session)))
+            results = [(connection, self._receive(connection)) for connection in active_connections]
+
+            # The shards can differ by one batch, the workers are dropped from the epoch when theirs is done
+            active_connections = [connection for connection, result in results if result is not None]
+            results = [result for _, result in results if result is not None]
+            if not results:
+                break
+
+            num_examples = float(sum(batch_size for batch_size, _, _ in results))
+            loss = sum(batch_size * batch_loss for batch_size, batch_loss, _ in results) / num_examples
+            gradients = [sum(batch_size * batch_gradients[i] for batch_size, _, batch_gradients in results) / num_examples
+                         for i in xrange(len(model.variables))]
+            gradient_norm = model.apply_gradients(session, gradients)
+
+            total_loss += loss
+            num_batches += 1
+
+            if num_batches % print_every == 0:
+                logging.info("step %d: loss = %f, gradient norm = %f, %d workers (%f secs)" %
+                             (num_batches, loss, gradient_norm, len(results), time.time() - tic))
+
+        return total_loss / max(num_batches, 1)
+
+
+    def close(self):
+        # A failed worker has already exited and closed its end of the pipe
+        self._broadcast([connection for connection, worker in zip(self.connections, self.workers) if worker.is_alive()],
+                        ('stop',))
+        for connection in self.connections:
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+def do_data_parallel_test():
+    """Checks that a step over two workers is the step of one batch of both shards."""
+    from qa_model import get_test_qa_system
+
+    def build_model():
+        return get_test_qa_system(max_context_length = 10, size = 4, optimizer = "sgd")
+
+    # The same lengths everywhere, so that the batches of the workers are padded as the whole batch
+    dataset = {'question_ids': [[3, 2, 1, 1, 3], [3, 1, 3, 2, 2], [2, 4, 1, 1, 4], [1, 1, 2, 3, 4]],
+               'context_ids': [[4, 4, 1, 2, 2, 4, 1, 3], [1, 4, 2, 3, 3, 1, 4, 1], [2, 3, 1, 1, 4, 2, 3, 1], [4, 1, 2, 2, 3, 3, 4, 1]],
+               'spans': np.array([[1, 3], [5, 5], [0, 1], [2, 4]], dtype = np.int32)}
+
+    # One batch per worker
+    with DataParallelTrainer(build_model, dataset, num_workers = 2, batch_size = 4, seed = 0) as trainer:
+        model = build_model()
+        with tf.Session(graph = model.graph) as session:
+            with model.graph.as_default():
+                session.run(tf.global_variables_initializer())
+            initial_weights = model.get_weights(session)
+
+            loss = trainer.run_epoch(session, model)
+            parallel_weights = model.get_weights(session)
+
+            model.set_weights(session, initial_weights)
+            batch = data_util.make_batch(dataset, np.arange(4), 5, 10, 5)
+            expected_loss, gradients = model.compute_gradients(session, batch)
+            model.apply_gradients(session, gradients)
+            expected_weights = model.get_weights(session)
+
+    assert np.isclose(loss, expected_loss, rtol = 1e-4)
+    assert all(np.allclose(parallel, expected, atol = 1e-5) for parallel, expected in zip(parallel_weights, expected_weights)), \
+        "the averaged gradients should be the gradients of the whole batch."
+    print("loss = " + str(loss))
+
+    # The traceback of a failed worker is raised by the training, and the trainer still closes
+    def build_broken_model():
+        raise ValueError("broken model")
+
+    try:
+        with DataParallelTrainer(build_broken_model, dataset, num_workers = 2, batch_size = 4) as trainer:
+            with tf.Session(graph = model.graph) as session:
+                with model.graph.as_default():
+                    session.run(tf.global_variables_initializer())
+                trainer.run_epoch(session, model)
+        assert False, "the failure of the workers should be raised."
+    except RuntimeError as e:
+        assert "broken model" in str(e), "the error should have the traceback of the worker."
+
+
+if __name__ == "__main__":
+    do_data_parallel_test()
@@ -0,0 +1,132 @@
+"""Incremental reader of (SQuAD like) JSON files.
+
+json.load keeps the whole tree of the file in memory.  The readers here decode the file one article (or one
+prediction) at a time, so only the current record has to fit in memory.
+"""
+import io
+import json
+
+WHITESPACE = u' \t\n\r'
+
+decoder = json.JSONDecoder()
+
+
+class JSONStream(object):
+    """Buffered reader decoding the values of a JSON text one by one.
+
+    Only the part of the text that isn't decoded yet is buffered.  A value that doesn't fit in the buffer is
+    retried with twice as much text, until it is complete.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = u''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self, size):
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def peek(self):
+        """Skips the whitespace and returns the next character, or '' at the end of the text."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return u''
+            self._fill(self.chunk_size)
+
+    def expect(self, characters):
+        """Consumes the next character, which must be one of characters, and returns it."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of %r but got %r" % (characters, character))
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decodes the next value."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may go on in the rest of the text
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+
+def iter_array(stream):
+    """Yields the values of the array starting at the stream position."""
+    stream.expect(u'[')
+    if stream.peek() == u']':
+        stream.position += 1
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(u',]') == u']':
+            return
+
+
+def iter_object(stream):
+    """Yields the keys of the object starting at the stream position.
+
+    The value of every key is left in the stream, the caller has to read it (with stream.value() or
+    iter_array(stream)) before asking for the next key.
+    """
+    stream.expect(u'{')
+    if stream.peek() == u'}':
+        stream.position += 1
+        return
+    while True:
+        key = stream.value()
+        stream.expect(u':')
+        yield key
+        if stream.expect(u',}') == u'}':
+            return
+
+
+def iter_articles(path, top_level=None):
+    """Yields the articles of the 'data' array of a SQuAD file one by one.
+
+    The other top level values (e.g. the 'version') are stored in the top_level dict when one is given.
+    """
+    with io.open(path, encoding='utf-8') as f:
+        stream = JSONStream(f)
+        for key in iter_object(stream):
+            if key == u'data':
+                for article in iter_array(stream):
+                    yield article
+            else:
+                value = stream.value()
+                if top_level is not None:
+                    top_level[key] = value
+
+
+def iter_records(path, top_level=None):
+    """Yields the (article, paragraph, qa) of every question of a SQuAD file."""
+    for article in iter_articles(path, top_level):
+        for paragraph in article['paragraphs']:
+            for qa in paragraph['qas']:
+                yield article, paragraph, qa
+
+
+def iter_items(path):
+    """Yields the (key, value) pairs of a JSON object file (e.g. the uuid -> answer predictions) one by one."""
+    with io.open(path, encoding='utf-8') as f:
+        stream = JSONStream(f)
+        for key in iter_object(stream):
+            yield key, stream.value()
@@ -1,17 +1,22 @@
 from __future__ import print_function
 import argparse
 import json
-import linecache
 import nltk
 import numpy as np
 import os
+import shutil
 import sys
+import tempfile
 from tqdm import tqdm
 import random
 
 from collections import Counter
+from itertools import chain
+from six.moves import zip
 from six.moves.urllib.request import urlretrieve
 
+from json_stream import iter_articles
+
 reload(sys)
 sys.setdefaultencoding('utf8')
 random.seed(42)
@@ -71,6 +76,12 @@ def data_from_json(filename):
     return data
 
 
+def stream_data_from_json(filename):
+    """Same layout as data_from_json, but 'data' is an iterator reading the articles from the file one at a
+    time, so the dataset doesn't have to fit in memory (it can only be iterated once)."""
+    return {'data': iter_articles(filename)}
+
+
 def list_topics(data):
     list_topics = [data['data'][idx]['title'] for idx in range(0,len(data['data']))]
     return list_topics
@@ -81,21 +92,46 @@ def tokenize(sequence):
     return map(lambda x:x.encode('utf8'), tokens)
 
 
+def token_char_offsets(context, context_tokens):
+    """Aligns the tokens with the context in a single pass over both.
+
+    The characters of every token are matched one by one with the context, skipping the spaces between (and
+    inside) them.  Returns the arrays of the start and end (exclusive) character offsets of every token.  When
+    a token doesn't match the context, it and all the following tokens are left unaligned, with offsets -1.
+    """
+    token_starts = np.full(len(context_tokens), -1, dtype=np.int64)
+    token_ends = np.full(len(context_tokens), -1, dtype=np.int64)
+
+    char_idx = 0
+    for token_idx, token in enumerate(context_tokens):
+        token = unicode(token)
+        token_start = None
+        for token_char in token:
+            while char_idx < len(context) and context[char_idx] == u' ':
+                char_idx += 1
+            if char_idx == len(context) or context[char_idx] != token_char:
+                return token_starts, token_ends
+            if token_start is None:
+                token_start = char_idx
+            char_idx += 1
+        if token_start is not None:
+            token_starts[token_idx] = token_start
+            token_ends[token_idx] = char_idx
+    return token_starts, token_ends
+
+
+def token_at(token_starts, char_idx):
+    """Returns the index of the token starting at char_idx, or -1 if there is none."""
+    token_idx = np.searchsorted(token_starts, char_idx)
+    if token_idx < len(token_starts) and token_starts[token_idx] == char_idx:
+        return token_idx
+    return -1
+
+
 def token_idx_map(context, context_tokens):
-    acc = ''
-    current_token_idx = 0
-    token_map = dict()
-
-    for char_idx, char in enumerate(context):
-        if char != u' ':
-            acc += char
-            context_token = unicode(context_tokens[current_token_idx])
-            if acc == context_token:
-                syn_start = char_idx - len(acc) + 1
-                token_map[syn_start] = [acc, current_token_idx]
-                acc = ''
-                current_token_idx += 1
-    return token_map
+    token_starts, token_ends = token_char_offsets(context, context_tokens)
+    return dict((start, [context[start:end].replace(u' ', u''), token_idx])
+                for token_idx, (start, end) in enumerate(zip(token_starts, token_ends)) if start >= 0)
 
 
 def invert_map(answer_map):
@@ -114,8 +150,8 @@ def read_write_dataset(dataset, tier, prefix):
          open(os.path.join(prefix, tier +'.answer'), 'w') as text_file, \
          open(os.path.join(prefix, tier +'.span'), 'w') as span_file:
 
-        for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-            article_paragraphs = dataset['data'][articles_id]['paragraphs']
+        for article in tqdm(dataset['data'], desc="Preprocessing {}".format(tier)):
+            article_paragraphs = article['paragraphs']
             for pid in range(len(article_paragraphs)):
                 context = article_paragraphs[pid]['context']
                 # The following replacements are suggested in the paper
@@ -124,7 +160,10 @@ def read_write_dataset(dataset, tier, prefix):
                 context = context.replace("``", '" ')
 
                 context_tokens = tokenize(context)
-                answer_map = token_idx_map(context, context_tokens)
+                token_starts, _ = token_char_offsets(context, context_tokens)
+
+                # The unaligned tokens (-1) are all at the end, so the aligned starts are sorted
+                token_starts = token_starts[:np.count_nonzero(token_starts >= 0)]
 
                 qas = article_paragraphs[pid]['qas']
                 for qid in range(len(qas)):
@@ -148,18 +187,17 @@ def read_write_dataset(dataset, tier, prefix):
 
                         last_word_answer = len(text_tokens[-1]) # add one to get the first char
 
-                        try:
-                            a_start_idx = answer_map[answer_start][1]
+                        a_start_idx = token_at(token_starts, answer_start)
 
-                            a_end_idx = answer_map[answer_end - last_word_answer][1]
+                        a_end_idx = token_at(token_starts, answer_end - last_word_answer)
 
+                        if a_start_idx >= 0 and a_end_idx >= 0:
                             # remove length restraint since we deal with it later
                             context_file.write(' '.join(context_tokens) + '\n')
                             question_file.write(' '.join(question_tokens) + '\n')
                             text_file.write(' '.join(text_tokens) + '\n')
                             span_file.write(' '.join([str(a_start_idx), str(a_end_idx)]) + '\n')
-
-                        except Exception as e:
+                        else:
                             skipped += 1
 
                         an += 1
@@ -168,35 +206,93 @@ def read_write_dataset(dataset, tier, prefix):
     return qn,an
 
 
-def save_files(prefix, tier, indices):
-  with open(os.path.join(prefix, tier + '.context'), 'w') as context_file,  \
-     open(os.path.join(prefix, tier + '.question'), 'w') as question_file,\
-     open(os.path.join(prefix, tier + '.answer'), 'w') as text_file, \
-     open(os.path.join(prefix, tier + '.span'), 'w') as span_file:
+split_extensions = ['context', 'question', 'answer', 'span']
 
-    for i in indices:
-      context_file.write(linecache.getline(os.path.join(prefix, 'train.context'), i))
-      question_file.write(linecache.getline(os.path.join(prefix, 'train.question'), i))
-      text_file.write(linecache.getline(os.path.join(prefix, 'train.answer'), i))
-      span_file.write(linecache.getline(os.path.join(prefix, 'train.span'), i))
 
+def read_rows(paths):
+    """Yields the rows of parallel files, as tuples with one line of every file."""
+    files = [open(path) for path in paths]
+    try:
+        for row in zip(*files):
+            yield tuple(line if line.endswith('\n') else line + '\n' for line in row)
+    finally:
+        for f in files:
+            f.close()
+
+
+def read_bucket(path, rng=None):
+    """Yields the rows written in a bucket file, in a random order if rng is given (the bucket is then
+    loaded in memory) or streamed in order otherwise."""
+    row_size = len(split_extensions)
+    with open(path) as bucket:
+        if rng is None:
+            for row in zip(*[bucket] * row_size):
+                yield row
+        else:
+            lines = bucket.readlines()
+            for i in rng.permutation(len(lines) // row_size):
+                yield tuple(lines[i * row_size:(i + 1) * row_size])
+
+
+def write_rows(rows, paths):
+    files = [open(path, 'w') for path in paths]
+    try:
+        for row in rows:
+            for f, line in zip(files, row):
+                f.write(line)
+    finally:
+        for f in files:
+            f.close()
+
+
+def split_tier(prefix, train_percentage = 0.9, shuffle=False, seed=None, max_rows_in_memory=1000000):
+    """Splits the train files into train and val files, reading the train files once.
+
+    The rows are assigned to the tiers with a seeded permutation.  When shuffling, the rows of a tier are
+    scattered to random bucket files which are then shuffled in memory one at a time (an external shuffle),
+    so no more than about max_rows_in_memory rows are ever loaded.
+    """
+    rng = np.random.RandomState(seed)
+    paths = [os.path.join(prefix, 'train.' + extension) for extension in split_extensions]
 
-def split_tier(prefix, train_percentage = 0.9, shuffle=False):
-    # Get number of lines in file
-    context_filename = os.path.join(prefix, 'train' + '.context')
     # Get the number of lines
-    with open(context_filename) as current_file:
+    with open(paths[0]) as current_file:
         num_lines = sum(1 for line in current_file)
-    # Get indices and split into two files
-    indices_dev = range(num_lines)[int(num_lines * train_percentage):]
-    if shuffle:
-        np.random.shuffle(indices_dev)
-        print("Shuffling...")
-    save_files(prefix, 'val', indices_dev)
-    indices_train = range(num_lines)[:int(num_lines * train_percentage)]
-    if shuffle:
-        np.random.shuffle(indices_train)
-    save_files(prefix, 'train', indices_train)
+    num_train = int(num_lines * train_percentage)
+    num_rows = {'train': num_train, 'val': num_lines - num_train}
+
+    is_train = np.zeros(num_lines, dtype=bool)
+    is_train[rng.permutation(num_lines)[:num_train]] = True
+
+    # The train files are overwritten, so everything is written in a scratch directory first
+    scratch_dir = tempfile.mkdtemp(dir=prefix)
+    try:
+        bucket_paths = {}
+        for tier in ['train', 'val']:
+            # Buckets are half of max_rows_in_memory on average, to leave room for the random bucket sizes
+            num_buckets = max(1, -(-2 * num_rows[tier] // max_rows_in_memory)) if shuffle else 1
+            bucket_paths[tier] = [os.path.join(scratch_dir, '{}.bucket{}'.format(tier, i)) for i in range(num_buckets)]
+
+        bucket_files = dict((tier, [open(path, 'w') for path in bucket_paths[tier]]) for tier in bucket_paths)
+        try:
+            for i, row in enumerate(read_rows(paths)):
+                tier_buckets = bucket_files['train' if is_train[i] else 'val']
+                tier_buckets[rng.randint(len(tier_buckets))].write(''.join(row))
+        finally:
+            for files in bucket_files.values():
+                for f in files:
+                    f.close()
+
+        for tier in ['val', 'train']:
+            if shuffle:
+                print("Shuffling {}...".format(tier))
+            tier_paths = [os.path.join(scratch_dir, tier + '.' + extension) for extension in split_extensions]
+            rows = chain.from_iterable(read_bucket(path, rng if shuffle else None) for path in bucket_paths[tier])
+            write_rows(rows, tier_paths)
+            for tier_path in tier_paths:
+                os.rename(tier_path, os.path.join(prefix, os.path.basename(tier_path)))
+    finally:
+        shutil.rmtree(scratch_dir)
 
 
 if __name__ == '__main__':
@@ -217,7 +313,7 @@ if __name__ == '__main__':
 
     maybe_download(squad_base_url, train_filename, download_prefix, 30288272L)
 
-    train_data = data_from_json(os.path.join(download_prefix, train_filename))
+    train_data = stream_data_from_json(os.path.join(download_prefix, train_filename))
 
     train_num_questions, train_num_answers = read_write_dataset(train_data, 'train', data_prefix)
 
@@ -227,7 +323,7 @@ if __name__ == '__main__':
     # 1. Split train into train and validation into 95-5
     # 2. Shuffle train, validation
     print("Splitting the dataset into train and validation")
-    split_tier(data_prefix, 0.95, shuffle=True)
+    split_tier(data_prefix, 0.95, shuffle=True, seed=42)
 
     print("Processed {} questions and {} answers in train".format(train_num_questions, train_num_answers))
 
@@ -7,6 +7,7 @@ import os
 import json
 import sys
 import random
+import time
 from os.path import join as pjoin
 
 from tqdm import tqdm
@@ -14,10 +15,11 @@ import numpy as np
 from six.moves import xrange
 import tensorflow as tf
 
-from qa_model import Encoder, QASystem, Decoder
-from preprocessing.squad_preprocess import data_from_json, maybe_download, squad_base_url, \
-    invert_map, tokenize, token_idx_map
+from qa_model import Encoder, QASystem, Decoder, InferenceEngine
+from preprocessing.squad_preprocess import stream_data_from_json, maybe_download, squad_base_url, \
+    invert_map, tokenize, token_idx_map, token_char_offsets
 import qa_data
+import data_util
 
 import logging
 
@@ -27,7 +29,7 @@ FLAGS = tf.app.flags.FLAGS
 
 tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
-tf.app.flags.DEFINE_integer("batch_size", 10, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use during prediction.")
 tf.app.flags.DEFINE_integer("epochs", 0, "Number of epochs to train.")
 tf.app.flags.DEFINE_integer("state_size", 200, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained vocabulary.")
@@ -38,19 +40,13 @@ tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
 tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
 tf.app.flags.DEFINE_string("dev_path", "data/squad/dev-v1.1.json", "Path to the JSON dev set to evaluate against (default: ./data/squad/dev-v1.1.json)")
-
-def initialize_model(session, model, train_dir):
-    ckpt = tf.train.get_checkpoint_state(train_dir)
-    v2_path = ckpt.model_checkpoint_path + ".index" if ckpt else ""
-    if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
-        logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
-    else:
-        logging.info("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
-        logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
-    return model
-
+tf.app.flags.DEFINE_integer("max_question_length", 20, "Max length of the questions")
+tf.app.flags.DEFINE_integer("max_context_length", 200, "Max length of the contexts")
+tf.app.flags.DEFINE_integer("max_answer_length", 15, "Max length of the answers")
+tf.app.flags.DEFINE_string("dtype", "float32", "Floating point type used by the model: float32 / float64")
+tf.app.flags.DEFINE_boolean("boundary_model", False, "Use the boundary model (only predict the answer start and end) instead of the sequence model")
+tf.app.flags.DEFINE_boolean("fused_bidirectional", False, "Run both match LSTM directions as one recurrence with shared weights (not checkpoint compatible with the default)")
+tf.app.flags.DEFINE_integer("context_cache_size", 1000, "How many paragraphs to keep the context encodings of, 0 disables the cache.")
 
 def initialize_vocab(vocab_path):
     if tf.gfile.Exists(vocab_path):
@@ -65,16 +61,22 @@ def initialize_vocab(vocab_path):
 
 
 def read_dataset(dataset, tier, vocab):
-    """Reads the dataset, extracts context, question, answer,
-    and answer pointer in their own file. Returns the number
-    of questions and answers processed for the dataset"""
-
-    context_data = []
-    query_data = []
-    question_uuid_data = []
-
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
+    """Reads the dataset, tokenizing and mapping every paragraph to ids once for all of its questions.
+
+    Returns a dict with the question ids and the context ids as data_util.MappedSequences (the context ids of
+    the questions of a paragraph are views of the same tokens), the paragraph index and the uuid of every
+    question, and for every paragraph its context and the start/end character offsets of its tokens."""
+
+    contexts = []
+    paragraph_token_ids = []
+    paragraph_token_starts = []
+    paragraph_token_ends = []
+    question_token_ids = []
+    paragraph_ids = []
+    question_uuids = []
+
+    for article in tqdm(dataset['data'], desc="Preprocessing {}".format(tier)):
+        article_paragraphs = article['paragraphs']
         for pid in range(len(article_paragraphs)):
             context = article_paragraphs[pid]['context']
             # The following replacements are suggested in the paper
@@ -83,71 +85,116 @@ def read_dataset(dataset, tier, vocab):
             context = context.replace("``", '" ')
 
             context_tokens = tokenize(context)
+            token_starts, token_ends = token_char_offsets(context, context_tokens)
+
+            paragraph_id = len(contexts)
+            contexts.append(context)
+            paragraph_token_ids.append([vocab.get(w, qa_data.UNK_ID) for w in context_tokens])
+            paragraph_token_starts.append(token_starts)
+            paragraph_token_ends.append(token_ends)
 
             qas = article_paragraphs[pid]['qas']
             for qid in range(len(qas)):
                 question = qas[qid]['question']
                 question_tokens = tokenize(question)
-                question_uuid = qas[qid]['id']
 
-                context_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in context_tokens]
-                qustion_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in question_tokens]
+                question_token_ids.append([vocab.get(w, qa_data.UNK_ID) for w in question_tokens])
+                paragraph_ids.append(paragraph_id)
+                question_uuids.append(qas[qid]['id'])
 
-                context_data.append(' '.join(context_ids))
-                query_data.append(' '.join(qustion_ids))
-                question_uuid_data.append(question_uuid)
+    paragraph_ids = np.array(paragraph_ids, dtype=np.int64)
+    context_tokens, context_offsets = data_util.flatten_sequences(paragraph_token_ids)
+    question_tokens, question_offsets = data_util.flatten_sequences(question_token_ids)
+    token_starts, _ = data_util.flatten_sequences(paragraph_token_starts, dtype=np.int64)
+    token_ends, _ = data_util.flatten_sequences(paragraph_token_ends, dtype=np.int64)
 
-    return context_data, query_data, question_uuid_data
+    return {'question_ids': data_util.MappedSequences(question_tokens, question_offsets[:-1], question_offsets[1:]),
+            'context_ids': data_util.MappedSequences(context_tokens, context_offsets[:-1][paragraph_ids],
+                                                     context_offsets[1:][paragraph_ids]),
+            'paragraph_ids': paragraph_ids,
+            'question_uuids': question_uuids,
+            'contexts': contexts,
+            'token_starts': data_util.MappedSequences(token_starts, context_offsets[:-1], context_offsets[1:]),
+            'token_ends': data_util.MappedSequences(token_ends, context_offsets[:-1], context_offsets[1:])}
 
 
 def prepare_dev(prefix, dev_filename, vocab):
     # Don't check file size, since we could be using other datasets
     dev_dataset = maybe_download(squad_base_url, dev_filename, prefix)
 
-    dev_data = data_from_json(os.path.join(prefix, dev_filename))
-    context_data, question_data, question_uuid_data = read_dataset(dev_data, 'dev', vocab)
+    dev_data = stream_data_from_json(os.path.join(prefix, dev_filename))
+    return read_dataset(dev_data, 'dev', vocab)
 
-    return context_data, question_data, question_uuid_data
 
+def answer_text(dataset, rev_vocab, question_index, start, end):
+    """Maps the [start, end] token span of the answer of a question back to the text of its paragraph, or to the
+    vocabulary words of its tokens when they couldn't be aligned with the paragraph."""
+    paragraph_id = dataset['paragraph_ids'][question_index]
+    char_start = dataset['token_starts'][paragraph_id][start]
+    char_end = dataset['token_ends'][paragraph_id][end]
+    if char_start >= 0 and char_end >= 0:
+        return dataset['contexts'][paragraph_id][char_start:char_end]
+    return ' '.join(rev_vocab[token_id] for token_id in dataset['context_ids'][question_index][start:end + 1])
 
-def generate_answers(sess, model, dataset, rev_vocab):
-    """
-    Loop over the dev or test dataset and generate answer.
 
-    Note: output format must be answers[uuid] = "real answer"
-    You must provide a string of words instead of just a list, or start and end index
+def iter_answers(engine, dataset, rev_vocab, batch_size, print_every=20):
+    """Yields the (uuid, answer text) of every question of the dataset.
 
-    In main() function we are dumping onto a JSON file
+    The questions are sorted by context length (then by paragraph) before being cut into batches, so that the
+    batches need little padding, and the questions of a paragraph fall in the same batches, where the context
+    encodings cached by the engine can be reused.
+    """
+    model = engine.model
+    paragraph_ids = dataset['paragraph_ids']
+    context_lengths = np.minimum(data_util.sequence_lengths(dataset['context_ids']), model.context_max_length)
+    order = np.lexsort((paragraph_ids, context_lengths))
 
-    evaluate.py will take the output JSON along with the original JSON file
-    and output a F1 and EM
+    num_examples = 0
+    tic = time.time()
+    for batch_number, batch_start in enumerate(xrange(0, len(order), batch_size)):
+        indices = order[batch_start:batch_start + batch_size]
+        batch = data_util.make_batch(dataset, indices, model.question_max_length, model.context_max_length,
+                                     model.max_answer_length)
+        starts, ends = engine.answer(batch, paragraph_ids[indices])
 
-    You must implement this function in order to submit to Leaderboard.
+        for question_index, start, end in zip(indices, starts, ends):
+            yield dataset['question_uuids'][question_index], answer_text(dataset, rev_vocab, question_index, start, end)
 
-    :param sess: active TF session
-    :param model: a built QASystem model
-    :param rev_vocab: this is a list of vocabulary that maps index to actual words
-    :return:
-    """
-    answers = {}
+        num_examples += len(indices)
+        if (batch_number + 1) % print_every == 0:
+            logging.info("answered %d questions (%f examples/sec)" % (num_examples, num_examples / (time.time() - tic)))
 
-    return answers
+    logging.info("answered %d questions in %f secs (%f examples/sec)" %
+                 (num_examples, time.time() - tic, num_examples / max(time.time() - tic, 1e-6)))
+    if engine.context_cache is not None:
+        logging.info("context cache: %d hits, %d misses" % (engine.context_cache.hits, engine.context_cache.misses))
 
 
-def get_normalized_train_dir(train_dir):
+def generate_answers(engine, dataset, rev_vocab, batch_size):
     """
-    Adds symlink to {train_dir} from /tmp/cs224n-squad-train to canonicalize the
-    file paths saved in the checkpoint. This allows the model to be reloaded even
-    if the location of the checkpoint files has moved, allowing usage with CodaLab.
-    This must be done on both train.py and qa_answer.py in order to work.
+    Loop over the dev or test dataset and generate answer.
+
+    Note: output format must be answers[uuid] = "real answer"
+    The answers are the text of the predicted spans in the original paragraphs (see iter_answers)
+
+    :param engine: an InferenceEngine, serving all the batches from its one session
+    :param dataset: the dataset returned by read_dataset
+    :param rev_vocab: this is a list of vocabulary that maps index to actual words
+    :param batch_size: number of questions per batch
+    :return: the dict of the answers
     """
-    global_train_dir = '/tmp/cs224n-squad-train'
-    if os.path.exists(global_train_dir):
-        os.unlink(global_train_dir)
-    if not os.path.exists(train_dir):
-        os.makedirs(train_dir)
-    os.symlink(os.path.abspath(train_dir), global_train_dir)
-    return global_train_dir
+    return dict(iter_answers(engine, dataset, rev_vocab, batch_size))
+
+
+def write_answers(answers, path):
+    """Streams the (uuid, answer) pairs to the JSON predictions file, as they are generated."""
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(u'{')
+        for i, (uuid, answer) in enumerate(answers):
+            if i > 0:
+                f.write(u', ')
+            f.write(unicode(json.dumps(uuid, ensure_ascii=False)) + u': ' + unicode(json.dumps(answer, ensure_ascii=False)))
+        f.write(u'}')
 
 
 def main(_):
@@ -170,25 +217,30 @@ def main(_):
 
     dev_dirname = os.path.dirname(os.path.abspath(FLAGS.dev_path))
     dev_filename = os.path.basename(FLAGS.dev_path)
-    context_data, question_data, question_uuid_data = prepare_dev(dev_dirname, dev_filename, vocab)
-    dataset = (context_data, question_data, question_uuid_data)
+    dataset = prepare_dev(dev_dirname, dev_filename, vocab)
 
     # ========= Model-specific =========
     # You must change the following code to adjust to your model
 
-    encoder = Encoder(size=FLAGS.state_size, vocab_dim=FLAGS.embedding_size)
-    decoder = Decoder(output_size=FLAGS.output_size)
+    pretrained_embeddings = np.load(embed_path)['glove']
+    encoder = Encoder(size=FLAGS.state_size,
+                      pretrained_embeddings = pretrained_embeddings,
+                      max_question_length = FLAGS.max_question_length,
+                      max_context_length = FLAGS.max_context_length,
+                      fused_bidirectional = FLAGS.fused_bidirectional,
+                      dtype = tf.as_dtype(FLAGS.dtype))
+    decoder = Decoder(output_size=FLAGS.output_size,
+                      size = FLAGS.state_size,
+                      max_context_length = FLAGS.max_context_length,
+                      max_answer_length = FLAGS.max_answer_length,
+                      boundary_model = FLAGS.boundary_model,
+                      dtype = tf.as_dtype(FLAGS.dtype))
 
     qa = QASystem(encoder, decoder)
 
-    with tf.Session() as sess:
-        train_dir = get_normalized_train_dir(FLAGS.train_dir)
-        initialize_model(sess, qa, train_dir)
-        answers = generate_answers(sess, qa, dataset, rev_vocab)
-
+    with InferenceEngine(qa, FLAGS.train_dir, context_cache_size = FLAGS.context_cache_size) as engine:
         # write to json file to root dir
-        with io.open('dev-prediction.json', 'w', encoding='utf-8') as f:
-            f.write(unicode(json.dumps(answers, ensure_ascii=False)))
+        write_answers(iter_answers(engine, dataset, rev_vocab, FLAGS.batch_size), 'dev-prediction.json')
 
 
 if __name__ == "__main__":
@@ -7,6 +7,9 @@ import os
 import re
 import tarfile
 import argparse
+from array import array
+from collections import Counter
+from multiprocessing import Pool
 
 from six.moves import urllib
 
@@ -35,6 +38,7 @@ def setup_args():
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=100, type=int)
     parser.add_argument("--random_init", default=True, type=bool)
+    parser.add_argument("--num_workers", default=1, type=int)
     return parser.parse_args()
 
 
@@ -58,9 +62,87 @@ def initialize_vocabulary(vocabulary_path):
         raise ValueError("Vocabulary file %s not found.", vocabulary_path)
 
 
-def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
+def file_byte_ranges(path, num_shards):
+    """Splits a file in num_shards (start, end) byte ranges, which all start at the beginning of a line."""
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for shard in range(1, num_shards):
+            f.seek(max(size * shard // num_shards, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+
+def read_lines(path, start, end):
+    """Yields the lines of a file that start in the [start, end) byte range."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            yield f.readline()
+
+
+# Vocabulary of the worker processes, sent once when their pool is created
+_worker_vocab = None
+
+
+def _set_worker_vocab(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def map_shards(function, shards, num_workers=1, vocab=None):
+    """Yields function(shard) for every shard, in order.  The shards are spread over a pool of num_workers
+    processes (which all get vocab) when num_workers > 1, otherwise they are processed in this process."""
+    if num_workers > 1:
+        pool = Pool(num_workers, initializer=_set_worker_vocab, initargs=(vocab,))
+        try:
+            for result in pool.imap(function, shards):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _set_worker_vocab(vocab)
+        for shard in shards:
+            yield function(shard)
+
+
+def _find_glove_vectors(shard):
+    """Returns the vocabulary indices matched by the GloVe lines of a byte range (by the word itself, its
+    capitalized and its upper case forms, in this order) and their vectors.  Only the vectors of the matched
+    lines are parsed, all at once.  Raises a ValueError with the byte offset of the first matched line that
+    doesn't have glove_dim values."""
+    glove_path, start, end, glove_dim = shard
+    targets = []
+    vector_strings = []
+    offsets = []
+    offset = start
+    for line in read_lines(glove_path, start, end):
+        word, _, vector_string = line.strip().partition(b" ")
+        for form in (word, word.capitalize(), word.upper()):
+            idx = _worker_vocab.get(form)
+            if idx is not None:
+                targets.append(idx)
+                vector_strings.append(vector_string)
+                offsets.append(offset)
+        offset += len(line)
+    vectors = np.fromstring(b" ".join(vector_strings), dtype=np.float64, sep=" ")
+    if vectors.size != len(targets) * glove_dim:
+        # Missing, extra or unparsable values, found line by line
+        for vector_string, offset in zip(vector_strings, offsets):
+            if (len(vector_string.split()) != glove_dim or
+                    np.fromstring(vector_string, dtype=np.float64, sep=" ").size != glove_dim):
+                raise ValueError("%s: the line at byte %d doesn't have %d numbers: %r" %
+                                 (glove_path, offset, glove_dim, vector_string[:80]))
+    return np.array(targets, dtype=np.int64), vectors.reshape(-1, glove_dim)
+
+
+def process_glove(args, vocab_list, save_path, random_init=True, num_workers=1, num_shards=40):
     """
     :param vocab_list: [vocab]
+    :param num_workers: number of processes the GloVe file shards are spread over
     :return:
     """
     if not gfile.Exists(save_path + ".npz"):
@@ -69,52 +151,55 @@ def process_glove(args, vocab_list, save_path, size=4e5, random_init=True):
             glove = np.random.randn(len(vocab_list), args.glove_dim)
         else:
             glove = np.zeros((len(vocab_list), args.glove_dim))
-        found = 0
-        with open(glove_path, 'r') as fh:
-            for line in tqdm(fh, total=size):
-                array = line.lstrip().rstrip().split(" ")
-                word = array[0]
-                vector = list(map(float, array[1:]))
-                if word in vocab_list:
-                    idx = vocab_list.index(word)
-                    glove[idx, :] = vector
-                    found += 1
-                if word.capitalize() in vocab_list:
-                    idx = vocab_list.index(word.capitalize())
-                    glove[idx, :] = vector
-                    found += 1
-                if word.upper() in vocab_list:
-                    idx = vocab_list.index(word.upper())
-                    glove[idx, :] = vector
-                    found += 1
+
+        # Like vocab_list.index, keep the first index of a word
+        vocab = dict((word, idx) for idx, word in reversed(list(enumerate(vocab_list))))
+
+        shards = [(glove_path, start, end, args.glove_dim) for start, end in file_byte_ranges(glove_path, num_shards)]
+        results = map_shards(_find_glove_vectors, shards, num_workers, vocab)
+
+        targets = []
+        vectors = []
+        for shard_targets, shard_vectors in tqdm(results, total=len(shards)):
+            targets.append(shard_targets)
+            vectors.append(shard_vectors)
+
+        targets = np.concatenate(targets)
+        vectors = np.concatenate(vectors).reshape(-1, args.glove_dim)
+        found = len(targets)
+
+        # When a word is matched more than once, the last vector in the file wins, as if they were assigned one by one
+        rows, last_matches = np.unique(targets[::-1], return_index=True)
+        glove[rows, :] = vectors[::-1][last_matches]
 
         print("{}/{} of word vocab have corresponding vectors in {}".format(found, len(vocab_list), glove_path))
         np.savez_compressed(save_path, glove=glove)
         print("saved trimmed glove matrix at: {}".format(save_path))
 
 
-def create_vocabulary(vocabulary_path, data_paths, tokenizer=None):
+def _count_tokens(shard):
+    path, start, end, tokenizer = shard
+    counts = Counter()
+    for line in read_lines(path, start, end):
+        counts.update(tokenizer(line) if tokenizer else basic_tokenizer(line))
+    return counts
+
+
+def create_vocabulary(vocabulary_path, data_paths, tokenizer=None, num_workers=1, num_shards=40):
+    """Counts the tokens of the data files, split in byte range shards that are spread over num_workers
+    processes, and writes the vocabulary sorted by decreasing count, and by word for the same count (so that it
+    doesn't depend on the order the shards are merged in).  With num_workers > 1, the tokenizer
+    must be a module level function so that it can be sent to the workers."""
     if not gfile.Exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" % (vocabulary_path, str(data_paths)))
-        vocab = {}
-        for path in data_paths:
-            with open(path, mode="rb") as f:
-                counter = 0
-                for line in f:
-                    counter += 1
-                    if counter % 100000 == 0:
-                        print("processing line %d" % counter)
-                    tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-                    for w in tokens:
-                        if w in vocab:
-                            vocab[w] += 1
-                        else:
-                            vocab[w] = 1
-        vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+        shards = [(path, start, end, tokenizer) for path in data_paths for start, end in file_byte_ranges(path, num_shards)]
+        vocab = Counter()
+        for counts in tqdm(map_shards(_count_tokens, shards, num_workers), total=len(shards)):
+            vocab.update(counts)
+        vocab_list = _START_VOCAB + sorted(vocab, key=lambda word: (-vocab[word], word))
         print("Vocabulary size: %d" % len(vocab_list))
         with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-            for w in vocab_list:
-                vocab_file.write(w + b"\n")
+            vocab_file.write(b"\n".join(vocab_list) + b"\n")
 
 
 def sentence_to_token_ids(sentence, vocabulary, tokenizer=None):
@@ -125,20 +210,50 @@ def sentence_to_token_ids(sentence, vocabulary, tokenizer=None):
     return [vocabulary.get(w, UNK_ID) for w in words]
 
 
+def _tokens_to_ids(shard):
+    """Returns the token ids lines of a shard as one block of text."""
+    path, start, end, tokenizer = shard
+    return "".join(" ".join([str(tok) for tok in sentence_to_token_ids(line, _worker_vocab, tokenizer)]) + "\n"
+                   for line in read_lines(path, start, end))
+
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None):
+                      tokenizer=None, num_workers=1, num_shards=40):
+    """Writes the token ids of every line of data_path to target_path.  The byte range shards of the data are
+    tokenized by num_workers processes, and their token ids are written in order, one block per shard."""
     if not gfile.Exists(target_path):
         print("Tokenizing data in %s" % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
-        with gfile.GFile(data_path, mode="rb") as data_file:
-            with gfile.GFile(target_path, mode="w") as tokens_file:
-                counter = 0
-                for line in data_file:
-                    counter += 1
-                    if counter % 5000 == 0:
-                        print("tokenizing line %d" % counter)
-                    token_ids = sentence_to_token_ids(line, vocab, tokenizer)
-                    tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+        shards = [(data_path, start, end, tokenizer) for start, end in file_byte_ranges(data_path, num_shards)]
+        with gfile.GFile(target_path, mode="w") as tokens_file:
+            for token_ids in tqdm(map_shards(_tokens_to_ids, shards, num_workers, vocab), total=len(shards)):
+                tokens_file.write(token_ids)
+
+
+def data_to_binary(ids_path):
+    """Converts a token ids file (one sequence per line) to its binary format: the flat int32 array of all the
+    tokens ({ids_path}.tokens.npy) and the int64 offsets of every sequence in it ({ids_path}.offsets.npy).
+    data_util.MappedSequences memory maps them back."""
+    tokens_path = ids_path + ".tokens.npy"
+    if not gfile.Exists(tokens_path):
+        print("Writing binary token ids for %s" % ids_path)
+        tokens = array('i')
+        offsets = array('l', [0])
+        with gfile.GFile(ids_path, mode="rb") as ids_file:
+            for line in ids_file:
+                tokens.extend(int(token) for token in line.split())
+                offsets.append(len(tokens))
+        np.save(tokens_path, np.frombuffer(tokens, dtype=np.int32) if tokens else np.zeros(0, dtype=np.int32))
+        np.save(ids_path + ".offsets.npy", np.array(offsets, dtype=np.int64))
+
+
+def spans_to_binary(span_path):
+    """Converts an answer span file (start end per line) to a [N x 2] int32 array ({span_path}.npy)."""
+    if not gfile.Exists(span_path + ".npy"):
+        print("Writing binary spans for %s" % span_path)
+        with gfile.GFile(span_path, mode="rb") as span_file:
+            spans = np.array([[int(index) for index in line.split()] for line in span_file], dtype=np.int32)
+        np.save(span_path + ".npy", spans.reshape(-1, 2))
 
 
 if __name__ == '__main__':
@@ -153,14 +268,15 @@ if __name__ == '__main__':
                       [pjoin(args.source_dir, "train.context"),
                        pjoin(args.source_dir, "train.question"),
                        pjoin(args.source_dir, "val.context"),
-                       pjoin(args.source_dir, "val.question")])
+                       pjoin(args.source_dir, "val.question")],
+                      num_workers=args.num_workers)
     vocab, rev_vocab = initialize_vocabulary(pjoin(args.vocab_dir, "vocab.dat"))
 
     # ======== Trim Distributed Word Representation =======
     # If you use other word representations, you should change the code below
 
     process_glove(args, rev_vocab, args.source_dir + "/glove.trimmed.{}".format(args.glove_dim),
-                  random_init=args.random_init)
+                  random_init=args.random_init, num_workers=args.num_workers)
 
     # ======== Creating Dataset =========
     # We created our data files seperately
@@ -169,10 +285,18 @@ if __name__ == '__main__':
 
     x_train_dis_path = train_path + ".ids.context"
     y_train_ids_path = train_path + ".ids.question"
-    data_to_token_ids(train_path + ".context", x_train_dis_path, vocab_path)
-    data_to_token_ids(train_path + ".question", y_train_ids_path, vocab_path)
+    data_to_token_ids(train_path + ".context", x_train_dis_path, vocab_path, num_workers=args.num_workers)
+    data_to_token_ids(train_path + ".question", y_train_ids_path, vocab_path, num_workers=args.num_workers)
 
     x_dis_path = valid_path + ".ids.context"
     y_ids_path = valid_path + ".ids.question"
-    data_to_token_ids(valid_path + ".context", x_dis_path, vocab_path)
-    data_to_token_ids(valid_path + ".question", y_ids_path, vocab_path)
\ No newline at end of file
+    data_to_token_ids(valid_path + ".context", x_dis_path, vocab_path, num_workers=args.num_workers)
+    data_to_token_ids(valid_path + ".question", y_ids_path, vocab_path, num_workers=args.num_workers)
+
+    # ======== Binary Dataset =========
+    # Memory mapped by train.py, so that it doesn't have to parse the token ids files
+
+    for path in [x_train_dis_path, y_train_ids_path, x_dis_path, y_ids_path]:
+        data_to_binary(path)
+    spans_to_binary(train_path + ".span")
+    spans_to_binary(valid_path + ".span")
\ No newline at end of file
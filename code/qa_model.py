@@ -1,19 +1,47 @@
+import os
+import re
 import time
 import logging
+from collections import OrderedDict
 
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 
-from evaluate import exact_match_score, f1_score
+from evaluate import exact_match_score, f1_score, score_answers
 import utils
+import span_util
+import data_util
+from checkpoint_manager import CheckpointManager, latest_checkpoint
 import match_lstm_cell
 import answer_pointer_cell
 
 logging.basicConfig(level=logging.INFO)
 
 
+# The names of the weights exported for qa_model_np, by the pattern of the variable names (in all the modes)
+NUMPY_WEIGHT_NAMES = [(r'encoder/(question_rnn|context_rnn)/lstm_cell/(kernel|bias)$', r'\1/\2'),
+                      (r'encoder/match_lstm_(fw|bw)_attention/(W_q)$', r'match_lstm_\1/\2'),
+                      (r'encoder/match_lstm_birnn/(fw|bw)/MatchLSTMCell/(W_q|W_p|W_r|b_p|w_a|b_a)$', r'match_lstm_\1/\2'),
+                      (r'encoder/match_lstm_birnn/(fw|bw)/MatchLSTMCell/MatchLSTMCell/(kernel|bias)$', r'match_lstm_\1/\2'),
+                      (r'encoder/match_lstm_attention/(W_q)$', r'match_lstm/\1'),
+                      (r'encoder/match_lstm_rnn/MatchLSTMCell/(W_q|W_p|W_r|b_p|w_a|b_a)$', r'match_lstm/\1'),
+                      (r'encoder/match_lstm_rnn/MatchLSTMCell/MatchLSTMCell/(kernel|bias)$', r'match_lstm/\1'),
+                      (r'decoder/ap_attention/(V)$', r'answer_pointer/\1'),
+                      # v is v_1 when V is created in the same scope (op names are unique regardless of the case)
+                      (r'decoder/ap_rnn/AnswerPointerCell/(V|W|b|v|c)(_1)?$', r'answer_pointer/\1'),
+                      (r'decoder/ap_rnn/AnswerPointerCell/AnswerPointerCell/(kernel|bias)$', r'answer_pointer/\1')]
+
+
+def numpy_weight_name(variable_name):
+    for pattern, replacement in NUMPY_WEIGHT_NAMES:
+        match = re.search(pattern, variable_name)
+        if match:
+            return match.expand(replacement)
+    raise ValueError("No NumPy weight for the variable %s" % variable_name)
+
+
 def get_optimizer(opt):
     if opt == "adam":
         optfn = tf.train.AdamOptimizer
@@ -25,77 +53,168 @@ def get_optimizer(opt):
 
 
 class Encoder(object):
-    def __init__(self, size, pretrained_embeddings, max_question_length, max_context_length, initialize_with_one = False):
+    def __init__(self, size, pretrained_embeddings, max_question_length, max_context_length, initialize_with_one = False,
+                 precompute_attention = True, fused_bidirectional = False, recompute_attention = False, dtype = tf.float32):
         self.size = size
-        self.pretrained_embeddings = pretrained_embeddings
+        self.dtype = dtype
+        self.pretrained_embeddings = np.asarray(pretrained_embeddings, dtype = dtype.as_numpy_dtype)
         self.question_max_length = max_question_length
         self.context_max_length = max_context_length
 
         # This flag is used mostly for testing
         self.initialize_with_one = initialize_with_one
 
+        # Compute the match LSTM question projection once per batch instead of at every context step
+        self.precompute_attention = precompute_attention
+
+        # Run the two directions of the match LSTM as one recurrence over a doubled batch, with weights shared by
+        # both directions (see build_fused_match_lstm).  The variables differ from the default mode, so the
+        # checkpoints of one mode can't be restored in the other.
+        self.fused_bidirectional = fused_bidirectional
+
+        # Compute the match LSTM attention again in the backward pass instead of keeping its [Batch Size x Q x L]
+        # intermediates for every context step (about a fifth of the memory of a training step at batch 32, 200
+        # context and 20 question tokens, for 5-15% more time per step).  It needs the precomputed attention.  The
+        # variables are the same, so the checkpoints are compatible.
+        self.recompute_attention = recompute_attention
+
         self.encodings = None
         self.context_lengths_placeholder = None
-        self.encoder_graph = self._build_encoder_graph()
 
+        # The outputs of the context LSTM, which only depend on the paragraph (not on the question), so they
+        # can be computed once per paragraph and fed back in for all of its questions (see InferenceEngine)
+        self.context_word_encodings = None
 
-    def _build_encoder_graph(self):
-        with tf.Graph().as_default() as encoder_graph:
-            self.question_ids_placeholder = tf.placeholder(tf.int32, shape = (None, self.question_max_length), name = 'question_ids_placeholder')
-            self.question_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'question_lengths_placeholder')
-            question_embeddings = tf.nn.embedding_lookup(self.pretrained_embeddings, self.question_ids_placeholder)
+        # The stand-alone graph and its session are only created on the first call to encode(), and then
+        # kept alive for every following call.  QASystem doesn't need them since it builds its own graph.
+        self.encoder_graph = None
+        self.session = None
 
-            if self.initialize_with_one:
-                initializer = tf.ones_initializer()
-            else:
-                initializer = tf.orthogonal_initializer()
 
-            # Create LSTM sequence for the question
-            question_lstm_cell = tf.contrib.rnn.LSTMCell(num_units = self.size,
-                                                         initializer = initializer)
+    def build(self, question_ids, question_lengths, context_ids, context_lengths):
+        """Adds the encoder ops to the current default graph and returns the encodings tensor.
 
-            question_word_encodings, _ = tf.nn.dynamic_rnn(cell = question_lstm_cell,
-                                                           dtype = tf.float64,
-                                                           sequence_length = self.question_lengths_placeholder,
-                                                           inputs = question_embeddings,
-                                                           scope = 'question_rnn')
+        This is used both by the stand-alone encoder graph and by QASystem, which builds the
+        encoder and the decoder into one graph so that they can be served from a single session.
 
-            # Create LSTM sequence for the context paragraph
-            self.context_ids_placeholder = tf.placeholder(tf.int32, shape = (None, self.context_max_length), name = 'context_ids_placeholder')
+        The questions and the contexts only need to be padded to the longest sequence of their batch.
+        """
+        num_question_tokens = tf.shape(question_ids)[1]
+        question_embeddings = tf.nn.embedding_lookup(self.pretrained_embeddings, question_ids)
+
+        if self.initialize_with_one:
+            initializer = tf.ones_initializer()
+        else:
+            initializer = tf.orthogonal_initializer()
+
+        # Create LSTM sequence for the question
+        question_lstm_cell = tf.contrib.rnn.LSTMCell(num_units = self.size,
+                                                     initializer = initializer)
+
+        question_word_encodings, _ = tf.nn.dynamic_rnn(cell = question_lstm_cell,
+                                                       dtype = self.dtype,
+                                                       sequence_length = question_lengths,
+                                                       inputs = question_embeddings,
+                                                       scope = 'question_rnn')
+
+        # Create LSTM sequence for the context paragraph
+        context_embeddings =  tf.nn.embedding_lookup(self.pretrained_embeddings, context_ids)
+
+        context_lstm_cell = tf.contrib.rnn.LSTMCell(num_units = self.size,
+                                                    initializer = initializer)
+
+        context_word_encodings, _ = tf.nn.dynamic_rnn(cell = context_lstm_cell,
+                                                      dtype = self.dtype,
+                                                      sequence_length = context_lengths,
+                                                      inputs = context_embeddings,
+                                                      scope = 'context_rnn')
+        self.context_word_encodings = context_word_encodings
+
+        if self.fused_bidirectional:
+            match_lstm_encodings = self.build_fused_match_lstm(question_word_encodings, question_lengths, num_question_tokens,
+                                                               context_word_encodings, context_lengths, initializer)
+            return tf.concat(values = [match_lstm_encodings[0], match_lstm_encodings[1]], axis = 2, name = 'encodings')
+
+        # Create Match LSTM sequence for the context (combination of the context token and attention weighted question for that token)
+        mlstm_cell_fw = match_lstm_cell.MatchLSTMCell(state_size = self.size,
+                                                      question_vector = question_word_encodings,
+                                                      question_mask = utils.create_softmax_mask(question_lengths, num_question_tokens, self.dtype),
+                                                      max_question_length = num_question_tokens,
+                                                      initializer = initializer,
+                                                      precompute_attention = self.precompute_attention,
+                                                      recompute_attention = self.recompute_attention,
+                                                      dtype = self.dtype)
+
+        mlstm_cell_bw = match_lstm_cell.MatchLSTMCell(state_size = self.size,
+                                                      question_vector = question_word_encodings,
+                                                      question_mask = utils.create_softmax_mask(question_lengths, num_question_tokens, self.dtype),
+                                                      max_question_length = num_question_tokens,
+                                                      initializer = initializer,
+                                                      precompute_attention = self.precompute_attention,
+                                                      recompute_attention = self.recompute_attention,
+                                                      dtype = self.dtype)
+
+        if self.precompute_attention:
+            mlstm_cell_fw.precompute_question_projection(scope = 'match_lstm_fw_attention')
+            mlstm_cell_bw.precompute_question_projection(scope = 'match_lstm_bw_attention')
+
+        match_lstm_encodings, _ = tf.nn.bidirectional_dynamic_rnn(cell_fw = mlstm_cell_fw,
+                                                                  cell_bw = mlstm_cell_bw,
+                                                                  dtype = self.dtype,
+                                                                  sequence_length = context_lengths,
+                                                                  inputs = context_word_encodings,
+                                                                  scope = 'match_lstm_birnn')
+
+        return tf.concat(values = [match_lstm_encodings[0], match_lstm_encodings[1]], axis = 2, name = 'encodings')
+
+
+    def build_fused_match_lstm(self, question_word_encodings, question_lengths, num_question_tokens, context_word_encodings,
+                               context_lengths, initializer):
+        """Runs both directions of the match LSTM as a single recurrence, with one cell shared by the two directions.
+
+        The batch is doubled: the contexts followed by the reversed contexts (each one reversed within its own
+        length), both attending over the same questions.  Every step is then one matmul over twice the rows
+        instead of two smaller ones, one per direction.
+
+        Returns the pair of the forward and the backward outputs, as bidirectional_dynamic_rnn does.
+        """
+        reversed_context_word_encodings = tf.reverse_sequence(context_word_encodings, context_lengths, seq_axis = 1, batch_axis = 0)
+        question_mask = utils.create_softmax_mask(question_lengths, num_question_tokens, self.dtype)
+
+        mlstm_cell = match_lstm_cell.MatchLSTMCell(state_size = self.size,
+                                                   question_vector = tf.concat([question_word_encodings, question_word_encodings], 0),
+                                                   question_mask = tf.concat([question_mask, question_mask], 0),
+                                                   max_question_length = num_question_tokens,
+                                                   initializer = initializer,
+                                                   precompute_attention = self.precompute_attention,
+                                                   recompute_attention = self.recompute_attention,
+                                                   dtype = self.dtype)
+
+        if self.precompute_attention:
+            mlstm_cell.precompute_question_projection(scope = 'match_lstm_attention')
+
+        outputs, _ = tf.nn.dynamic_rnn(cell = mlstm_cell,
+                                       dtype = self.dtype,
+                                       sequence_length = tf.concat([context_lengths, context_lengths], 0),
+                                       inputs = tf.concat([context_word_encodings, reversed_context_word_encodings], 0),
+                                       scope = 'match_lstm_rnn')                                                       # Dimensions = [2 * Batch Size x P x L]
+
+        outputs_fw, reversed_outputs_bw = tf.split(outputs, 2, axis = 0)
+        outputs_bw = tf.reverse_sequence(reversed_outputs_bw, context_lengths, seq_axis = 1, batch_axis = 0)
+        return outputs_fw, outputs_bw
+
+
+    def _build_encoder_graph(self):
+        with tf.Graph().as_default() as encoder_graph:
+            self.question_ids_placeholder = tf.placeholder(tf.int32, shape = (None, None), name = 'question_ids_placeholder')
+            self.question_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'question_lengths_placeholder')
+            self.context_ids_placeholder = tf.placeholder(tf.int32, shape = (None, None), name = 'context_ids_placeholder')
             self.context_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'context_lengths_placeholder')
-            context_embeddings =  tf.nn.embedding_lookup(self.pretrained_embeddings, self.context_ids_placeholder)
-
-            # Create LSTM sequence for the question
-            context_lstm_cell = tf.contrib.rnn.LSTMCell(num_units = self.size,
-                                                        initializer = initializer)
-
-            context_word_encodings, _ = tf.nn.dynamic_rnn(cell = context_lstm_cell,
-                                                          dtype = tf.float64,
-                                                          sequence_length = self.context_lengths_placeholder,
-                                                          inputs = context_embeddings,
-                                                          scope = 'context_rnn')
-
-            # Create Match LSTM sequence for the context (combination of the context token and attention weighted question for that token)
-            mlstm_cell_fw = match_lstm_cell.MatchLSTMCell(state_size = self.size,
-                                                          question_vector = question_word_encodings,
-                                                          question_mask = utils.create_softmax_mask(self.question_lengths_placeholder, self.question_max_length),
-                                                          max_question_length = self.question_max_length,
-                                                          initializer = initializer)
-
-            mlstm_cell_bw = match_lstm_cell.MatchLSTMCell(state_size = self.size,
-                                                          question_vector = question_word_encodings,
-                                                          question_mask = utils.create_softmax_mask(self.question_lengths_placeholder, self.question_max_length),
-                                                          max_question_length = self.question_max_length,
-                                                          initializer = initializer)
-
-            match_lstm_encodings, _ = tf.nn.bidirectional_dynamic_rnn(cell_fw = mlstm_cell_fw,
-                                                                      cell_bw = mlstm_cell_bw,
-                                                                      dtype = tf.float64, 
-                                                                      sequence_length = self.context_lengths_placeholder,
-                                                                      inputs = context_word_encodings,
-                                                                      scope = 'match_lstm_birnn')
-
-            self.encodings = tf.concat(values = [match_lstm_encodings[0], match_lstm_encodings[1]], axis = 2, name = 'encodings')
+
+            self.encodings = self.build(self.question_ids_placeholder,
+                                        self.question_lengths_placeholder,
+                                        self.context_ids_placeholder,
+                                        self.context_lengths_placeholder)
         return encoder_graph
 
     
@@ -115,56 +234,91 @@ class Encoder(object):
                  or both.
         """
         
+        if self.session is None:
+            self.encoder_graph = self._build_encoder_graph()
+            self.session = tf.Session(graph = self.encoder_graph)
+            with self.encoder_graph.as_default():
+                self.session.run(tf.global_variables_initializer())
+
         feed_dict = {self.question_ids_placeholder: dataset['train_question_ids'],
                      self.question_lengths_placeholder: dataset['train_question_lengths'],
                      self.context_ids_placeholder: dataset['train_context_ids'],
                      self.context_lengths_placeholder: dataset['train_context_lengths']}
 
-        with tf.Session(graph = self.encoder_graph) as sess:
-            sess.run(tf.global_variables_initializer())
-            outputs = sess.run(self.encodings, feed_dict=feed_dict)
+        outputs = self.session.run(self.encodings, feed_dict=feed_dict)
         
         return outputs
 
     
 
 class Decoder(object):
-    def __init__(self, output_size, size, max_context_length, max_answer_length):
+    def __init__(self, output_size, size, max_context_length, max_answer_length, precompute_attention = True,
+                 boundary_model = False, dtype = tf.float32):
         self.size = size
-        self.max_num_context_tokens = max_context_length + 1
+        self.dtype = dtype
         self.max_context_length = max_context_length
         self.max_answer_length = max_answer_length
 
-        self.decoder_graph = self._build_decoder_graph()
+        # The sequence model points to every answer token and then to the end of answer token (an extra zero
+        # vector), for max_answer_length steps.  The boundary model only points to the answer start and end.
+        self.boundary_model = boundary_model
+        if self.boundary_model:
+            self.num_answer_steps = 2
+        else:
+            self.num_answer_steps = max_answer_length
+
+        # Compute the answer pointer encoding projection once per batch instead of at every answer step
+        self.precompute_attention = precompute_attention
+
+        # See Encoder.__init__ for why these are created lazily
+        self.decoder_graph = None
+        self.session = None
+
+
+    def build(self, encodings, encodings_lengths):
+        """Adds the decoder ops to the current default graph and returns the answer softmaxes tensor.
+        """
+        batch_size = tf.shape(encodings)[0]
+        if self.boundary_model:
+            encodings_length = encodings_lengths
+        else:
+            # Add the zero vector to the encodings (for the end of answer token)
+            zero_vector = tf.fill(dims = (batch_size, 1, 2 * self.size), value = self.dtype.as_numpy_dtype(0.0))
+            encodings = tf.concat([encodings, zero_vector], 1)
+            encodings_length = encodings_lengths + 1
+        num_context_tokens = tf.shape(encodings)[1]
+
+        ap_cell = answer_pointer_cell.AnswerPointerCell(state_size = self.size,
+                                                        encodings = encodings,
+                                                        encodings_mask = utils.create_softmax_mask(encodings_length, num_context_tokens, self.dtype),
+                                                        max_num_context_tokens = num_context_tokens,
+                                                        precompute_attention = self.precompute_attention,
+                                                        dtype = self.dtype)
+
+        if self.precompute_attention:
+            ap_cell.precompute_encoding_projection(scope = 'ap_attention')
+
+        # The anwer pointer layer doesn't require any inputs (other than the encoded context and question), and it runs for a
+        # small fixed number of steps, so it is unrolled here instead of going through dynamic_rnn.  This also lets the number
+        # of context tokens (the size of its outputs) change from one batch to the next.
+        state = ap_cell.zero_state(batch_size, self.dtype)
+        answer_softmaxes = []
+        with tf.variable_scope('ap_rnn') as scope:
+            for step in xrange(self.num_answer_steps):
+                if step > 0:
+                    scope.reuse_variables()
+                answer_softmax, state = ap_cell(None, state)
+                answer_softmaxes.append(answer_softmax)
+
+        return tf.stack(answer_softmaxes, axis = 1, name = 'answer_softmaxes')
 
 
     def _build_decoder_graph(self):
         with tf.Graph().as_default() as decoder_graph:
-            self.encodings_placeholder = tf.placeholder(tf.float64, shape = (None, self.max_context_length, 2 * self.size), name = 'encodings_placeholder')
+            self.encodings_placeholder = tf.placeholder(self.dtype, shape = (None, None, 2 * self.size), name = 'encodings_placeholder')
             self.encodings_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'encodings_length_placeholder')
 
-            # Add the zero vector to the encodings (for the end of answer token)
-            batch_size = tf.shape(self.encodings_placeholder)[0]
-            zero_vector = tf.fill(dims = (batch_size, 1, 2 * self.size), value = np.float64(0.0))
-            encodings = tf.concat([self.encodings_placeholder, zero_vector], 1)
-            encodings_length = self.encodings_lengths_placeholder + 1
-
-            ap_cell = answer_pointer_cell.AnswerPointerCell(state_size = self.size,
-                                                            encodings = encodings,
-                                                            encodings_mask = utils.create_softmax_mask(encodings_length, self.max_num_context_tokens),
-                                                            max_num_context_tokens = self.max_num_context_tokens)
-
-            # dynamic_rnn function requires an input tensor.  The anwer pointer layer doesn't require any inputs (other than the encoded
-            # context and question),  so we need to generate a fake input tensor.
-            fake_inputs = tf.fill(dims = (batch_size, self.max_answer_length, 1), value = 0)
-            answer_softmaxes, _ = tf.nn.dynamic_rnn(cell = ap_cell,
-                                                    dtype = tf.float64,
-                                                    inputs = fake_inputs,
-                                                    scope = 'ap_rnn')
-
-            # Need to create a graph label for the answer_softmax computation node.  The tf.nn.dynamic_rnn function doesn't allow
-            # for setting that label, so I'm using the tf.identify function
-            self.answer_softmaxes = tf.identity(answer_softmaxes, 'answer_softmaxes')
+            self.answer_softmaxes = self.build(self.encodings_placeholder, self.encodings_lengths_placeholder)
 
         return decoder_graph
 
@@ -183,38 +337,94 @@ class Decoder(object):
         :return:
         """
 
+        if self.session is None:
+            self.decoder_graph = self._build_decoder_graph()
+            self.session = tf.Session(graph = self.decoder_graph)
+            with self.decoder_graph.as_default():
+                self.session.run(tf.global_variables_initializer())
+
         feed_dict = {self.encodings_placeholder: knowledge_rep,
                      self.encodings_lengths_placeholder: knowledge_rep_lengths}
 
-        with tf.Session(graph = self.decoder_graph) as sess:
-            sess.run(tf.global_variables_initializer())
-            outputs = sess.run(self.answer_softmaxes, feed_dict=feed_dict)
+        outputs = self.session.run(self.answer_softmaxes, feed_dict=feed_dict)
         
         return outputs
 
     
     
 class QASystem(object):
-    def __init__(self, encoder, decoder, *args):
+    def __init__(self, encoder, decoder, learning_rate = 0.01, optimizer = "adam", max_gradient_norm = 10.0,
+                 prefetch_batches = 4):
         """
         Initializes your System
 
         :param encoder: an encoder that you constructed in train.py
         :param decoder: a decoder that you constructed in train.py
-        :param args: pass in more arguments as needed
+        :param learning_rate: learning rate of the optimizer
+        :param optimizer: adam / sgd
+        :param max_gradient_norm: the gradients are clipped to this global norm
+        :param prefetch_batches: how many batches the input pipeline prepares ahead of the training steps
         """
         self.encoder = encoder
         self.decoder = decoder
+        self.question_max_length = encoder.question_max_length
+        self.context_max_length = encoder.context_max_length
+        self.max_answer_length = decoder.max_answer_length
+        self.num_answer_steps = decoder.num_answer_steps
         self.graph = tf.Graph()
 
         # ==== assemble pieces ====
-        with tf.variable_scope("qa", initializer=tf.uniform_unit_scaling_initializer(1.0)):
-            #self.setup_embeddings()
-            self.setup_system()
-            self.setup_loss()
+        with self.graph.as_default():
+            with tf.variable_scope("qa", initializer=tf.uniform_unit_scaling_initializer(1.0)):
+                #self.setup_embeddings()
+                self.setup_input_pipeline(prefetch_batches)
+                self.setup_system()
+                self.setup_loss()
+
+            # ==== set up training/updating procedure ====
+            self.setup_training(learning_rate, optimizer, max_gradient_norm)
+            self.saver = tf.train.Saver(save_relative_paths = True)
+            # Without the optimizer slots, so a checkpoint restores into a model built with any optimizer
+            self.model_saver = tf.train.Saver(tf.trainable_variables() + [self.global_step], save_relative_paths = True)
+
+
+    def setup_input_pipeline(self, prefetch_batches):
+        """
+        Sets up the tf.data pipeline that feeds the model inputs when they are not fed explicitly.
+
+        The batches are read from the python iterator self.input_batches (e.g. data_util.bucketed_batches, which
+        shuffles, buckets and pads them) on a background thread, and prefetched, so that the next batches are
+        prepared while the current step runs.  See start_input_pipeline.
+        :return:
+        """
+        self.input_batches = iter(())
+
+        output_types = {'question_ids': tf.int32,
+                        'question_lengths': tf.int32,
+                        'context_ids': tf.int32,
+                        'context_lengths': tf.int32,
+                        'answer_ids': tf.int32}
+        output_shapes = {'question_ids': tf.TensorShape([None, None]),
+                         'question_lengths': tf.TensorShape([None]),
+                         'context_ids': tf.TensorShape([None, None]),
+                         'context_lengths': tf.TensorShape([None]),
+                         'answer_ids': tf.TensorShape([None, self.num_answer_steps])}
 
-        # ==== set up training/updating procedure ====
-        pass
+        # The generator is called again every time the iterator is initialized
+        input_dataset = tf.data.Dataset.from_generator(lambda: self.input_batches, output_types, output_shapes)
+        input_iterator = input_dataset.prefetch(prefetch_batches).make_initializable_iterator()
+
+        self.input_initializer = input_iterator.initializer
+        self.input_batch = input_iterator.get_next()
+
+
+    def start_input_pipeline(self, session, batches):
+        """
+        Makes the input pipeline read the batches (an iterator of the dicts of create_feed_dict, with the answer_ids).
+        The following runs that don't feed the inputs take the next batch, until tf.errors.OutOfRangeError.
+        """
+        self.input_batches = batches
+        session.run(self.input_initializer)
 
 
     def setup_system(self):
@@ -222,34 +432,86 @@ class QASystem(object):
         After your modularized implementation of encoder and decoder
         you should call various functions inside encoder, decoder here
         to assemble your reading comprehension system!
+
+        The encoder and the decoder are built directly into self.graph (instead of importing their stand-alone
+        graphs), so that the whole model shares one set of variables and can be served from one session.
+
+        The placeholders default to the batches of the input pipeline, the pipeline doesn't run when they are fed.
         :return:
         """
-        with self.graph.as_default():
-            self.question_ids_placeholder = tf.placeholder(tf.int32, shape = (None, self.question_max_length), name = 'question_ids_placeholder')
-            self.question_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'question_lengths_placeholder')
-            self.context_ids_placeholder = tf.placeholder(tf.int32, shape = (None, self.context_max_length), name = 'context_ids_placeholder')
-            self.context_lengths_placeholder = tf.placeholder(tf.int32, shape = (None,), name = 'context_lengths_placeholder')
-            
-            encodings, = tf.import_graph_def(self.encoder.encoder_graph.as_graph_def(),
-                                             input_map = {'question_ids_placeholder:0': self.question_ids_placeholder,
-                                                          'question_lengths_placeholder:0': self.question_lengths_placeholder,
-                                                          'context_ids_placeholder:0': self.context_ids_placeholder,
-                                                          'context_lengths_placeholder:0': self.context_lengths_placeholder},
-                                             return_elements = ['encodings:0'])
-
-            self.answer_softmaxes, = tf.import_graph_def(self.decoder.decoder_graph.as_graph_def(),
-                                                         input_map = {'encodings_placeholder:0', encodings,
-                                                                      'encodings_length_placeholder:0', self.context_lenghts_placeholder},
-                                                         return_elements = ['answer_softmaxes'])
+        self.question_ids_placeholder = tf.placeholder_with_default(self.input_batch['question_ids'], shape = (None, None), name = 'question_ids_placeholder')
+        self.question_lengths_placeholder = tf.placeholder_with_default(self.input_batch['question_lengths'], shape = (None,), name = 'question_lengths_placeholder')
+        self.context_ids_placeholder = tf.placeholder_with_default(self.input_batch['context_ids'], shape = (None, None), name = 'context_ids_placeholder')
+        self.context_lengths_placeholder = tf.placeholder_with_default(self.input_batch['context_lengths'], shape = (None,), name = 'context_lengths_placeholder')
+        self.num_examples = tf.shape(self.context_lengths_placeholder)[0]
+
+        with tf.variable_scope('encoder'):
+            self.encodings = self.encoder.build(self.question_ids_placeholder,
+                                                self.question_lengths_placeholder,
+                                                self.context_ids_placeholder,
+                                                self.context_lengths_placeholder)
+
+        self.context_word_encodings = self.encoder.context_word_encodings
+
+        with tf.variable_scope('decoder'):
+            self.answer_softmaxes = self.decoder.build(self.encodings, self.context_lengths_placeholder)
         
         
     def setup_loss(self):
         """
         Set up your loss computation here
+
+        For the sequence model, the answer is the sequence of context token indices picked by the answer pointer,
+        padded with the end of answer token (index = context length) up to max_answer_length.  For the boundary
+        model, it is the (start, end) pair of context token indices.
         :return:
         """
-        with self.graph.as_default():
-            
+        self.answer_ids_placeholder = tf.placeholder_with_default(self.input_batch['answer_ids'], shape = (None, self.num_answer_steps), name = 'answer_ids_placeholder')
+
+        answer_probabilities = tf.reduce_sum(self.answer_softmaxes * tf.one_hot(self.answer_ids_placeholder,
+                                                                                 depth = tf.shape(self.answer_softmaxes)[2],
+                                                                                 dtype = self.answer_softmaxes.dtype), 2)
+        self.loss = -tf.reduce_mean(tf.reduce_sum(tf.log(answer_probabilities + 1e-10), 1))
+
+
+    def setup_training(self, learning_rate, optimizer, max_gradient_norm):
+        """
+        Set up the optimizer step, with the gradients clipped to max_gradient_norm
+
+        The step can also apply gradients computed outside of it (e.g. averaged over the workers of parallel_train),
+        fed to self.gradient_placeholders and clipped in the same way (see compute_gradients and apply_gradients).
+        :return:
+        """
+        self.global_step = tf.Variable(0, trainable = False, name = 'global_step')
+        self.optimizer = get_optimizer(optimizer)(learning_rate)
+
+        self.gradients, self.variables = zip(*self.optimizer.compute_gradients(self.loss))
+        gradients, self.gradient_norm = tf.clip_by_global_norm(self.gradients, max_gradient_norm)
+        self.train_op = self.optimizer.apply_gradients(zip(gradients, self.variables), global_step = self.global_step)
+
+        # The optimizer slots are shared with train_op
+        self.gradient_placeholders = [tf.placeholder(variable.dtype.base_dtype, shape = variable.get_shape(), name = 'gradient_placeholder')
+                                      for variable in self.variables]
+        gradients, self.fed_gradient_norm = tf.clip_by_global_norm(self.gradient_placeholders, max_gradient_norm)
+        self.apply_gradients_op = self.optimizer.apply_gradients(zip(gradients, self.variables), global_step = self.global_step)
+
+
+    def create_feed_dict(self, data):
+        """Maps a batch (dict with question_ids, question_lengths, context_ids, context_lengths and optionally
+        answer_ids) to the graph placeholders.
+
+        When the batch also has the (precomputed) context_word_encodings, they are fed in place of the context
+        LSTM outputs, so the context LSTM doesn't run."""
+        feed_dict = {self.question_ids_placeholder: data['question_ids'],
+                     self.question_lengths_placeholder: data['question_lengths'],
+                     self.context_ids_placeholder: data['context_ids'],
+                     self.context_lengths_placeholder: data['context_lengths']}
+        if 'answer_ids' in data:
+            feed_dict[self.answer_ids_placeholder] = data['answer_ids']
+        if 'context_word_encodings' in data:
+            feed_dict[self.context_word_encodings] = data['context_word_encodings']
+        return feed_dict
+
 
     def setup_embeddings(self):
         """
@@ -262,39 +524,126 @@ class QASystem(object):
             
         
 
-    def optimize(self, session, train_x, train_y):
+    def optimize(self, session, batch = None, num_micro_batches = 1):
         """
         Takes in actual data to optimize your model
         This method is equivalent to a step() function
-        :return:
+
+        The gradients can be accumulated over several micro-batches (a list of batches, or num_micro_batches batches
+        of the input pipeline) before one update, so that the step is the one of the batch of all their examples
+        but only the activations of one micro-batch are held in memory at a time.  The accumulated gradients are
+        clipped as the ones of a single batch.
+        :param batch: the batch to train on, a list of micro-batches, or None for the next batch(es) of the input pipeline
+        :param num_micro_batches: how many batches of the input pipeline make one step (when batch is None)
+        :return: the loss and the gradient norm of the batch
         """
-        input_feed = {}
+        if isinstance(batch, list):
+            return self._optimize_micro_batches(session, batch)
+        if batch is None and num_micro_batches > 1:
+            return self._optimize_micro_batches(session, [None] * num_micro_batches)
 
-        # fill in this feed_dictionary like:
-        # input_feed['train_x'] = train_x
+        input_feed = self.create_feed_dict(batch) if batch is not None else None
 
-        output_feed = []
+        output_feed = [self.train_op, self.loss, self.gradient_norm]
 
-        outputs = session.run(output_feed, input_feed)
+        _, loss, gradient_norm = session.run(output_feed, input_feed)
 
-        return outputs
+        return loss, gradient_norm
+
+    def _optimize_micro_batches(self, session, micro_batches):
+        """
+        Accumulates the gradients of the micro-batches (weighted by their number of examples, so that their sum is the
+        gradient of the mean loss of all the examples) and applies them
+        :return: the loss and the gradient norm of all the micro-batches
+        """
+        loss = 0.
+        gradients = None
+        num_examples = 0
+
+        for micro_batch in micro_batches:
+            input_feed = self.create_feed_dict(micro_batch) if micro_batch is not None else None
+            try:
+                outputs = session.run([self.loss, self.num_examples] + list(self.gradients), input_feed)
+            except tf.errors.OutOfRangeError:
+                # The end of the input pipeline, the micro-batches read so far still make a (smaller) step
+                if gradients is None:
+                    raise
+                break
+
+            batch_loss, batch_size, batch_gradients = outputs[0], outputs[1], outputs[2:]
+            loss += batch_size * batch_loss
+            num_examples += batch_size
+            if gradients is None:
+                gradients = [batch_size * gradient for gradient in batch_gradients]
+            else:
+                for gradient, batch_gradient in zip(gradients, batch_gradients):
+                    gradient += batch_size * batch_gradient
+
+        gradient_norm = self.apply_gradients(session, [gradient / float(num_examples) for gradient in gradients])
+
+        return loss / num_examples, gradient_norm
+
+    def compute_gradients(self, session, batch = None):
+        """
+        Computes the loss and the (unclipped) gradients of a batch, without updating the model
+        :param batch: the batch, or None for the next batch of the input pipeline
+        :return: the loss and the list of the gradients (in the order of self.variables)
+        """
+        input_feed = self.create_feed_dict(batch) if batch is not None else None
+
+        outputs = session.run([self.loss] + list(self.gradients), input_feed)
+
+        return outputs[0], outputs[1:]
 
-    def test(self, session, valid_x, valid_y):
+    def apply_gradients(self, session, gradients):
+        """
+        Clips the gradients (e.g. the average of the gradients of several batches) and updates the model with them
+        :return: the gradient norm
+        """
+        input_feed = dict(zip(self.gradient_placeholders, gradients))
+
+        _, gradient_norm = session.run([self.apply_gradients_op, self.fed_gradient_norm], input_feed)
+
+        return gradient_norm
+
+    def get_weights(self, session):
+        """Returns the values of the trainable variables (in the order of self.variables)."""
+        return session.run(list(self.variables))
+
+    def set_weights(self, session, weights):
+        """Assigns the values returned by get_weights (without adding ops to the graph)."""
+        for variable, value in zip(self.variables, weights):
+            variable.load(value, session)
+
+    def test(self, session, valid_x = None, valid_y = None):
         """
         in here you should compute a cost for your validation set
         and tune your hyperparameters according to the validation set performance
-        :return:
-        """
-        input_feed = {}
 
-        # fill in this feed_dictionary like:
-        # input_feed['valid_x'] = valid_x
+        :param valid_x: the batch, or None for the next batch of the input pipeline
+        :param valid_y: the answer ids of the batch (when they're not in valid_x)
+        :return: the loss of the batch
+        """
+        input_feed = None
+        if valid_x is not None:
+            input_feed = self.create_feed_dict(valid_x)
+            if valid_y is not None:
+                input_feed[self.answer_ids_placeholder] = valid_y
 
-        output_feed = []
+        return session.run(self.loss, input_feed)
 
-        outputs = session.run(output_feed, input_feed)
+    def encode_contexts(self, session, context_ids, context_lengths):
+        """
+        Returns the outputs of the context LSTM, which doesn't need the questions
+        """
+        return session.run(self.context_word_encodings, {self.context_ids_placeholder: context_ids,
+                                                         self.context_lengths_placeholder: context_lengths})
 
-        return outputs
+    def encode(self, session, test_x):
+        """
+        Returns the encodings of the (question, context) pairs in test_x
+        """
+        return session.run(self.encodings, self.create_feed_dict(test_x))
 
     def decode(self, session, test_x):
         """
@@ -302,12 +651,9 @@ class QASystem(object):
         so that other methods like self.answer() will be able to work properly
         :return:
         """
-        input_feed = {}
+        input_feed = self.create_feed_dict(test_x)
 
-        # fill in this feed_dictionary like:
-        # input_feed['test_x'] = test_x
-
-        output_feed = []
+        output_feed = self.answer_softmaxes
 
         outputs = session.run(output_feed, input_feed)
 
@@ -315,72 +661,156 @@ class QASystem(object):
 
     def answer(self, session, test_x):
 
-        yp, yp2 = self.decode(session, test_x)
-
-        a_s = np.argmax(yp, axis=1)
-        a_e = np.argmax(yp2, axis=1)
+        answer_softmaxes = self.decode(session, test_x)
 
-        return (a_s, a_e)
+        return span_util.answer_spans(answer_softmaxes, test_x['context_lengths'], self.max_answer_length,
+                                      self.decoder.boundary_model)
 
-    def validate(self, sess, valid_dataset):
+    def validate(self, sess, valid_dataset, batch_size = 100):
         """
         Iterate through the validation dataset and determine what
         the validation cost is.
 
-        This method calls self.test() which explicitly calculates validation cost.
-
-        How you implement this function is dependent on how you design
-        your data iteration function
+        This method calls self.test() which explicitly calculates validation cost, on the batches of the input
+        pipeline.  The loss is only defined for the answers the decoder can point to, so the examples marked as not
+        reachable in valid_dataset['reachable'] are left out.
 
-        :return:
+        :return: the average loss of the batches
         """
-        valid_cost = 0
-
-        for valid_x, valid_y in valid_dataset:
-          valid_cost = self.test(sess, valid_x, valid_y)
-
-
-        return valid_cost
-
-    def evaluate_answer(self, session, dataset, sample=100, log=False):
+        indices = np.arange(len(valid_dataset['spans']))
+        if 'reachable' in valid_dataset:
+            indices = indices[np.asarray(valid_dataset['reachable'])]
+
+        context_lengths = np.minimum(data_util.sequence_lengths(valid_dataset['context_ids'])[indices], self.context_max_length)
+        self.start_input_pipeline(sess, (data_util.make_batch(valid_dataset, indices[batch_positions],
+                                                              self.question_max_length,
+                                                              self.context_max_length,
+                                                              self.max_answer_length,
+                                                              boundary_model = self.decoder.boundary_model)
+                                         for batch_positions in data_util.bucketed_batch_indices(context_lengths, batch_size,
+                                                                                                 shuffle = False)))
+        valid_cost = 0.
+        num_batches = 0
+        while True:
+            try:
+                valid_cost += self.test(sess)
+            except tf.errors.OutOfRangeError:
+                break
+            num_batches += 1
+
+        return valid_cost / max(num_batches, 1)
+
+    def export_weights(self, session, path):
+        """Saves the weights (and the settings) of the model in a .npz file, for qa_model_np.QASystem.load"""
+        variables = self.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+        weights = dict((numpy_weight_name(variable.op.name), value)
+                       for variable, value in zip(variables, session.run(variables)))
+
+        weights['embeddings'] = self.encoder.pretrained_embeddings
+        weights['config/fused_bidirectional'] = self.encoder.fused_bidirectional
+        weights['config/boundary_model'] = self.decoder.boundary_model
+        weights['config/max_answer_length'] = self.max_answer_length
+        weights['config/question_max_length'] = self.question_max_length
+        weights['config/context_max_length'] = self.context_max_length
+        np.savez(path, **weights)
+
+    def evaluate_answer(self, session, dataset, sample=None, batch_size=100, rev_vocab=None, log=False):
         """
         Evaluate the model's performance using the harmonic mean of F1 and Exact Match (EM)
         with the set of true answer labels
 
-        This step actually takes quite some time. So we can only sample 100 examples
-        from either training or testing set.
+        The examples are answered in large batches of similar context lengths, and the metrics are computed on
+        the token spans (see span_util.span_scores), so the whole dataset can be evaluated after every epoch.
+        With rev_vocab, the string metrics of evaluate.py are computed instead, on the words of the token ids of
+        the spans.  This is still not the official metric: the words include the UNKs, and the true answer is
+        the token span rather than the SQuAD answer strings.
+
+        The examples marked as not reachable in dataset['reachable'] (the answers the model can't point to)
+        are counted as misses.
 
         :param session: session should always be centrally managed in train.py
         :param dataset: a representation of our data, in some implementations, you can
                         pass in multiple components (arguments) of one dataset to this function
-        :param sample: how many examples in dataset we look at
+        :param sample: how many examples in dataset we look at (None for all of them)
+        :param batch_size: number of examples per batch
+        :param rev_vocab: (optional) the list of the vocabulary words, for the official string metrics
         :param log: whether we print to std out stream
-        :return:
+        :return: the F1 and the EM, in percents
         """
+        spans = np.asarray(dataset['spans'])
+        indices = np.arange(len(spans))
+        if sample is not None and sample < len(indices):
+            indices = np.random.choice(indices, sample, replace=False)
+
+        reachable = np.asarray(dataset['reachable']) if 'reachable' in dataset else np.ones(len(spans), dtype=bool)
+        answered = indices[reachable[indices]]
 
+        context_lengths = np.minimum(data_util.sequence_lengths(dataset['context_ids']), self.context_max_length)
         f1 = 0.
         em = 0.
+        for batch_positions in data_util.bucketed_batch_indices(context_lengths[answered], batch_size, shuffle=False):
+            batch_indices = answered[batch_positions]
+            batch = data_util.make_batch(dataset, batch_indices, self.question_max_length, self.context_max_length,
+                                         self.max_answer_length, self.decoder.boundary_model)
+            starts, ends = self.answer(session, batch)
+
+            if rev_vocab is None:
+                batch_em, batch_f1 = span_util.span_scores(starts, ends, spans[batch_indices, 0], spans[batch_indices, 1])
+                em += np.sum(batch_em)
+                f1 += np.sum(batch_f1)
+                continue
+
+            for context_ids, start, end, (true_start, true_end) in zip(batch['context_ids'], starts, ends, spans[batch_indices]):
+                prediction = ' '.join(rev_vocab[token_id] for token_id in context_ids[start:end + 1])
+                ground_truth = ' '.join(rev_vocab[token_id] for token_id in context_ids[true_start:true_end + 1])
+                example_em, example_f1 = score_answers(prediction, [ground_truth])
+                em += example_em
+                f1 += example_f1
+
+        f1 = 100.0 * f1 / max(len(indices), 1)
+        em = 100.0 * em / max(len(indices), 1)
 
         if log:
-            logging.info("F1: {}, EM: {}, for {} samples".format(f1, em, sample))
+            logging.info("F1: {}, EM: {}, for {} samples ({} unreachable)".format(f1, em, len(indices), len(indices) - len(answered)))
 
         return f1, em
 
 
 
-    def run_epoch(self, session, training_data):
-        encoded_input = self.encoder.encode(session,
-                                            training_data,
-                                            None)
+    def run_epoch(self, session, dataset, batch_size, print_every = 1, num_micro_batches = 1):
+        """
+        Runs one pass over the training dataset, in batches bucketed by context length, read through the input pipeline
 
-        import numpy
-        numpy.set_printoptions(threshold=numpy.nan)
-        
-        print encoded_input
-        sys.exit(0)
+        With num_micro_batches > 1, the batches of batch_size examples are micro-batches, and every step accumulates
+        the gradients of num_micro_batches of them (see optimize).
+        :return: the average loss of the epoch
+        """
+        total_loss = 0.
+        num_batches = 0
+        tic = time.time()
+
+        self.start_input_pipeline(session, data_util.bucketed_batches(dataset, batch_size,
+                                                                      self.question_max_length,
+                                                                      self.context_max_length,
+                                                                      self.max_answer_length,
+                                                                      boundary_model = self.decoder.boundary_model))
+        while True:
+            try:
+                loss, gradient_norm = self.optimize(session, num_micro_batches = num_micro_batches)
+            except tf.errors.OutOfRangeError:
+                break
+            total_loss += loss
+            num_batches += 1
+
+            if num_batches % print_every == 0:
+                logging.info("batch %d: loss = %f, gradient norm = %f (%f secs)" %
+                             (num_batches, loss, gradient_norm, time.time() - tic))
+
+        return total_loss / max(num_batches, 1)
         
     
-    def train(self, session, dataset, train_dir):
+    def train(self, session, dataset, train_dir, epochs = 10, batch_size = 10, print_every = 1, eval_dataset = None,
+              parallel_trainer = None, keep = 0, num_micro_batches = 1):
         """
         Implement main training loop
 
@@ -400,13 +830,33 @@ class QASystem(object):
         :param session: it should be passed in from train.py
         :param dataset: a representation of our data, in some implementations, you can
                         pass in multiple components (arguments) of one dataset to this function
-        :param train_dir: path to the directory where you should save the model checkpoint
+        :param train_dir: path to the directory where you should save the model checkpoint (after every epoch, in the
+                          background, see CheckpointManager, and the best one by validation F1 to train_dir/best)
+        :param epochs: number of passes over the dataset
+        :param batch_size: number of examples per batch
+        :param print_every: how many batches to do per print
+        :param eval_dataset: (optional) the dataset evaluated (on the token spans) after every epoch
+        :param parallel_trainer: (optional) a parallel_train.DataParallelTrainer running the epochs over its workers
+                                 (which hold the dataset and the batch size) instead of this session
+        :param keep: how many checkpoints to keep, 0 keeps all of them
+        :param num_micro_batches: how many batches of batch_size examples to accumulate the gradients of per step
         :return:
         """
 
-        for epoch in range(100):
-            print "running epoch #%d" % epoch
-            self.run_epoch(session, dataset)
+        with CheckpointManager(self, train_dir, keep = keep) as checkpoints:
+            for epoch in range(epochs):
+                logging.info("running epoch #%d" % epoch)
+                if parallel_trainer is not None:
+                    epoch_loss = parallel_trainer.run_epoch(session, self, print_every)
+                else:
+                    epoch_loss = self.run_epoch(session, dataset, batch_size, print_every, num_micro_batches)
+                logging.info("epoch #%d: average loss = %f" % (epoch, epoch_loss))
+
+                f1 = None
+                if eval_dataset is not None:
+                    logging.info("epoch #%d: validation loss = %f" % (epoch, self.validate(session, eval_dataset)))
+                    f1, _ = self.evaluate_answer(session, eval_dataset, log = True)
+                checkpoints.save(session, score = f1)
 
         # some free code to print out number of parameters in your model
         # it's always good to check!
@@ -415,25 +865,176 @@ class QASystem(object):
         # even continue training
 
         tic = time.time()
-        params = tf.trainable_variables()
-        num_params = sum(map(lambda t: np.prod(tf.shape(t.value()).eval()), params))
+        params = self.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+        num_params = sum(map(lambda t: t.get_shape().num_elements(), params))
         toc = time.time()
         logging.info("Number of params: %d (retreival took %f secs)" % (num_params, toc - tic))
 
 
 
+class LRUCache(object):
+    """Fixed capacity mapping that evicts its least recently used entry."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move the entry to the most recently used end
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+
+class InferenceEngine(object):
+    """Long lived inference engine for a QASystem.
+
+    The session over the model's graph is created and the weights are restored (or initialized) once, in the
+    constructor.  Only the weights are restored (not the optimizer slots), so the model doesn't need to be built
+    with the optimizer the checkpoint was trained with.  All the following encode/decode/answer calls are served from that same session.
+
+    With a context_cache_size, the outputs of the context LSTM are cached by paragraph id (for the
+    context_cache_size most recently used paragraphs).  The calls given the paragraph_ids of their batch then
+    only run the context LSTM for the paragraphs that aren't cached, and feed the cached outputs to the match
+    LSTM for all the questions of the other paragraphs.
+    """
+    def __init__(self, model, train_dir = None, context_cache_size = 0):
+        self.model = model
+        self.session = tf.Session(graph = model.graph)
+        self.context_cache = LRUCache(context_cache_size) if context_cache_size > 0 else None
+
+        checkpoint_path = latest_checkpoint(train_dir)
+        if checkpoint_path:
+            logging.info("Reading model parameters from %s" % checkpoint_path)
+            model.model_saver.restore(self.session, checkpoint_path)
+        else:
+            logging.info("Created model with fresh parameters.")
+            with model.graph.as_default():
+                self.session.run(tf.global_variables_initializer())
+
+        # No more ops are going to be added, and this catches any accidental per call graph growth
+        model.graph.finalize()
+
+    def context_word_encodings(self, test_x, paragraph_ids):
+        """Returns the [Batch Size x T x size] context LSTM outputs of the batch, running the context LSTM (in one
+        batch) only for the paragraphs that are not cached yet."""
+        context_ids = np.asarray(test_x['context_ids'])
+        context_lengths = np.asarray(test_x['context_lengths'])
+
+        paragraph_encodings = {}
+        missing_rows = OrderedDict()
+        for row, paragraph_id in enumerate(paragraph_ids):
+            if paragraph_id in paragraph_encodings or paragraph_id in missing_rows:
+                continue
+            cached = self.context_cache.get(paragraph_id)
+            if cached is None:
+                missing_rows[paragraph_id] = row
+            else:
+                paragraph_encodings[paragraph_id] = cached
+
+        if missing_rows:
+            rows = list(missing_rows.values())
+            outputs = self.model.encode_contexts(self.session, context_ids[rows], context_lengths[rows])
+            for output, paragraph_id, row in zip(outputs, missing_rows.keys(), rows):
+                paragraph_encodings[paragraph_id] = output[:context_lengths[row]].copy()
+                self.context_cache.put(paragraph_id, paragraph_encodings[paragraph_id])
+
+        # The outputs past the end of a context are zeros, as the ones of dynamic_rnn
+        encodings = np.zeros(context_ids.shape + (self.model.encoder.size,), dtype = self.model.encoder.dtype.as_numpy_dtype)
+        for row, paragraph_id in enumerate(paragraph_ids):
+            encoding = paragraph_encodings[paragraph_id]
+            encodings[row, :len(encoding)] = encoding
+        return encodings
+
+    def _with_cached_contexts(self, test_x, paragraph_ids):
+        if paragraph_ids is None or self.context_cache is None:
+            return test_x
+        test_x = dict(test_x)
+        test_x['context_word_encodings'] = self.context_word_encodings(test_x, paragraph_ids)
+        return test_x
+
+    def encode(self, test_x, paragraph_ids = None):
+        return self.model.encode(self.session, self._with_cached_contexts(test_x, paragraph_ids))
+
+    def decode(self, test_x, paragraph_ids = None):
+        return self.model.decode(self.session, self._with_cached_contexts(test_x, paragraph_ids))
+
+    def answer(self, test_x, paragraph_ids = None):
+        return self.model.answer(self.session, self._with_cached_contexts(test_x, paragraph_ids))
+
+    def export_weights(self, path):
+        self.model.export_weights(self.session, path)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+def get_test_pretrained_embeddings():
+    return np.array([[0.418, 0.24968, -0.41242, 0.1217, 0.34527, -0.044457, -0.49688, -0.17862, -0.00066023, -0.6566],
+                     [0.013441, 0.23682, -0.16899, 0.40951, 0.63812, 0.47709, -0.42852, -0.55641, -0.364, -0.23938],
+                     [0.15164, 0.30177, -0.16763, 0.17684, 0.31719, 0.33973, -0.43478, -0.31086, -0.44999, -0.29486],
+                     [0.70853, 0.57088, -0.4716, 0.18048, 0.54449, 0.72603, 0.18157, -0.52393, 0.10381, -0.17566],
+                     [0.68047, -0.039263, 0.30186, -0.17792, 0.42962, 0.032246, -0.41376, 0.13228, -0.29847, -0.085253]],
+                    dtype = np.float64)
+
+
+def get_test_qa_system(max_context_length, size, precompute_attention = True, fused_bidirectional = False,
+                       boundary_model = False, dtype = tf.float32, **kwargs):
+    """Returns a QASystem over the test embeddings, for questions and answers of at most 5 tokens (the kwargs go
+    to QASystem)."""
+    test_encoder = Encoder(size = size,
+                           pretrained_embeddings = get_test_pretrained_embeddings(),
+                           max_context_length = max_context_length,
+                           max_question_length = 5,
+                           precompute_attention = precompute_attention,
+                           fused_bidirectional = fused_bidirectional,
+                           dtype = dtype)
+    test_decoder = Decoder(output_size = None,
+                           size = size,
+                           max_context_length = max_context_length,
+                           max_answer_length = 5,
+                           precompute_attention = precompute_attention,
+                           boundary_model = boundary_model,
+                           dtype = dtype)
+    return QASystem(test_encoder, test_decoder, **kwargs)
+
+
+def get_test_batch():
+    """Returns a batch of two questions (of 5 and 3 tokens) on contexts of 8 and 10 tokens."""
+    return {'question_ids': [[3, 2, 1, 1, 3], [3, 1, 3, 0, 0]],
+            'question_lengths': [5, 3],
+            'context_ids': [[4, 4, 1, 2, 2, 4, 1, 3, 0, 0], [1, 4, 2, 3, 3, 1, 4, 1, 3, 1]],
+            'context_lengths': [8, 10]}
+
+
 def run_encoder_tests(max_context_length, size):
-    test_pretrained_embeddings = np.array([[0.418, 0.24968, -0.41242, 0.1217, 0.34527, -0.044457, -0.49688, -0.17862, -0.00066023, -0.6566],
-                                           [0.013441, 0.23682, -0.16899, 0.40951, 0.63812, 0.47709, -0.42852, -0.55641, -0.364, -0.23938],
-                                           [0.15164, 0.30177, -0.16763, 0.17684, 0.31719, 0.33973, -0.43478, -0.31086, -0.44999, -0.29486],
-                                           [0.70853, 0.57088, -0.4716, 0.18048, 0.54449, 0.72603, 0.18157, -0.52393, 0.10381, -0.17566],
-                                           [0.68047, -0.039263, 0.30186, -0.17792, 0.42962, 0.032246, -0.41376, 0.13228, -0.29847, -0.085253]],
-                                          dtype = np.float64)
-        
     test_encoder = Encoder(size = size,
-                           pretrained_embeddings = test_pretrained_embeddings,
+                           pretrained_embeddings = get_test_pretrained_embeddings(),
                            max_context_length = max_context_length,
-                           max_question_length = 5)
+                           max_question_length = 5,
+                           dtype = tf.float64)
 
     question1_ids = [3, 2, 1, 1, 3]
     question2_ids = [3, 1, 3, 0, 0]
@@ -458,14 +1059,143 @@ def run_encoder_tests(max_context_length, size):
     return encodings, context_lengths
 
 
+def run_fused_encoder_tests(max_context_length, size):
+    """Checks that the fused bidirectional match LSTM gives the same encodings as bidirectional_dynamic_rnn, when
+    both directions of the latter use the weights of the fused cell."""
+    with tf.Graph().as_default():
+        question_ids = tf.constant([[3, 2, 1, 1, 3], [3, 1, 3, 0, 0]])
+        question_lengths = tf.constant([5, 3])
+        context_ids = tf.constant([[4, 4, 1, 2, 2, 4, 1, 3, 0, 0], [1, 4, 2, 3, 3, 1, 4, 1, 3, 1]])
+        context_lengths = tf.constant([8, 10])
+
+        encodings = {}
+        for fused_bidirectional in [False, True]:
+            test_encoder = Encoder(size = size,
+                                   pretrained_embeddings = get_test_pretrained_embeddings(),
+                                   max_context_length = max_context_length,
+                                   max_question_length = 5,
+                                   fused_bidirectional = fused_bidirectional,
+                                   dtype = tf.float64)
+            with tf.variable_scope('fused' if fused_bidirectional else 'default'):
+                encodings[fused_bidirectional] = test_encoder.build(question_ids, question_lengths, context_ids, context_lengths)
+
+        fused_variables = dict((v.name, v) for v in tf.global_variables() if v.name.startswith('fused/'))
+        copy_ops = []
+        for v in tf.global_variables():
+            if v.name.startswith('default/'):
+                fused_name = v.name.replace('default/', 'fused/', 1)
+                for direction in ['fw', 'bw']:
+                    fused_name = fused_name.replace('match_lstm_%s_attention' % direction, 'match_lstm_attention')
+                    fused_name = fused_name.replace('match_lstm_birnn/%s' % direction, 'match_lstm_rnn')
+                copy_ops.append(tf.assign(v, fused_variables[fused_name]))
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(copy_ops)
+            default_encodings, fused_encodings = sess.run([encodings[False], encodings[True]])
+
+    assert np.allclose(default_encodings, fused_encodings), "the fused match LSTM should give the same encodings."
+    return fused_encodings
+
+
 def run_decoder_tests(encodings, encodings_lengths, max_context_length, size):
     test_decoder = Decoder(output_size = None,
                            size = size,
                            max_context_length = max_context_length,
-                           max_answer_length = 5)
+                           max_answer_length = 5,
+                           dtype = tf.float64)
 
     answer_softmaxes = test_decoder.decode(encodings, encodings_lengths)
     return answer_softmaxes
+
+
+def run_qa_system_tests(max_context_length, size, boundary_model = False, dtype = tf.float32):
+    test_x = get_test_batch()
+
+    with InferenceEngine(get_test_qa_system(max_context_length, size, boundary_model = boundary_model, dtype = dtype)) as engine:
+        # Repeated calls are served by the same session, so they must see the same weights
+        first_answer = engine.answer(test_x)
+        second_answer = engine.answer(test_x)
+        assert all(np.array_equal(first, second) for first, second in zip(first_answer, second_answer))
+        return first_answer
+
+
+def run_numpy_inference_tests(max_context_length, size, precompute_attention = True, fused_bidirectional = False,
+                              boundary_model = False):
+    """Checks that qa_model_np, with the exported weights, gives the same answer softmaxes as the TensorFlow model."""
+    import tempfile
+    import qa_model_np
+
+    qa = get_test_qa_system(max_context_length, size,
+                            precompute_attention = precompute_attention,
+                            fused_bidirectional = fused_bidirectional,
+                            boundary_model = boundary_model,
+                            dtype = tf.float64)
+    test_x = get_test_batch()
+
+    weights_file = tempfile.NamedTemporaryFile(suffix = '.npz')
+    with weights_file, InferenceEngine(qa) as engine:
+        engine.export_weights(weights_file.name)
+        numpy_model = qa_model_np.QASystem.load(weights_file.name)
+
+        assert np.allclose(engine.decode(test_x), numpy_model.decode(test_x)), "the NumPy model should give the same answer softmaxes."
+        assert all(np.array_equal(tf_span, np_span) for tf_span, np_span in zip(engine.answer(test_x), numpy_model.answer(test_x)))
+        return numpy_model.answer(test_x)
+
+
+def run_context_cache_tests(max_context_length, size):
+    # Three questions on two paragraphs, padded to 10 context tokens in the first batch and 8 in the second
+    question_ids = [[3, 2, 1, 1, 3], [3, 1, 3, 0, 0], [2, 2, 4, 0, 0]]
+    contexts = {0: [4, 4, 1, 2, 2, 4, 1, 3], 1: [1, 4, 2, 3, 3, 1, 4, 1, 3, 1]}
+    batches = [[0, 1, 1], [1, 0, 0]]
+
+    with InferenceEngine(get_test_qa_system(max_context_length, size, dtype = tf.float64), context_cache_size = 1) as engine:
+        for paragraph_ids in batches:
+            test_x = {'question_ids': question_ids,
+                      'question_lengths': [5, 3, 3]}
+            test_x['context_ids'], test_x['context_lengths'] = data_util.pad_sequences([contexts[p] for p in paragraph_ids])
+
+            expected = engine.decode(test_x)
+            cached = engine.decode(test_x, paragraph_ids)
+            assert np.allclose(expected, cached), "the cached context encodings should give the same answers."
+
+        # The cache only holds one paragraph, so every batch had to encode one of its paragraphs again
+        assert len(engine.context_cache) == 1
+        return engine.context_cache.hits, engine.context_cache.misses
+
+
+def run_gradient_accumulation_tests(max_context_length, size):
+    qa = get_test_qa_system(max_context_length, size, dtype = tf.float64, optimizer = "sgd", max_gradient_norm = 1.0)
+
+    # The same lengths everywhere, so that the micro-batches are padded as the whole batch
+    dataset = {'question_ids': [[3, 2, 1, 1, 3], [3, 1, 3, 2, 2], [2, 4, 1, 1, 4]],
+               'context_ids': [[4, 4, 1, 2, 2, 4, 1, 3], [1, 4, 2, 3, 3, 1, 4, 1], [2, 3, 1, 1, 4, 2, 3, 1]],
+               'spans': np.array([[1, 3], [5, 5], [0, 1]], dtype = np.int32)}
+
+    def batch(indices):
+        return data_util.make_batch(dataset, np.array(indices), 5, max_context_length, 5)
+
+    with tf.Session(graph = qa.graph) as session:
+        with qa.graph.as_default():
+            session.run(tf.global_variables_initializer())
+        initial_weights = qa.get_weights(session)
+
+        loss, gradient_norm = qa.optimize(session, batch([0, 1, 2]))
+        expected_weights = qa.get_weights(session)
+
+        # Micro-batches of different sizes, and then through the input pipeline
+        qa.set_weights(session, initial_weights)
+        accumulated_loss, accumulated_gradient_norm = qa.optimize(session, [batch([0]), batch([1, 2])])
+        assert np.isclose(loss, accumulated_loss) and np.isclose(gradient_norm, accumulated_gradient_norm)
+        assert all(np.allclose(weights, expected) for weights, expected in zip(qa.get_weights(session), expected_weights)), \
+            "the accumulated step should be the step of the whole batch."
+
+        qa.set_weights(session, initial_weights)
+        qa.start_input_pipeline(session, iter([batch([2, 0]), batch([1])]))
+        qa.optimize(session, num_micro_batches = 3)
+        assert all(np.allclose(weights, expected) for weights, expected in zip(qa.get_weights(session), expected_weights))
+
+        return accumulated_loss, accumulated_gradient_norm
     
     
 
@@ -474,5 +1204,14 @@ if __name__ == '__main__':
     size = 10
     encodings, encodings_lengths = run_encoder_tests(max_context_length, size)
     print(encodings)
+    print(run_fused_encoder_tests(max_context_length, size))
     answer_softmaxes = run_decoder_tests(encodings, encodings_lengths, max_context_length, size)
     print(answer_softmaxes)
+    print(run_qa_system_tests(max_context_length, size))
+    print(run_qa_system_tests(max_context_length, size, boundary_model = True))
+    print(run_qa_system_tests(max_context_length, size, dtype = tf.float64))
+    print(run_context_cache_tests(max_context_length, size))
+    print(run_gradient_accumulation_tests(max_context_length, size))
+    print(run_numpy_inference_tests(max_context_length, size))
+    print(run_numpy_inference_tests(max_context_length, size, precompute_attention = False, boundary_model = True))
+    print(run_numpy_inference_tests(max_context_length, size, fused_bidirectional = True))
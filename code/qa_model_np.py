@@ -1,2 +1,134 @@
-def lstm():
-    
+"""NumPy (TensorFlow free) inference for the model of qa_model.
+
+The weights are exported from a trained TensorFlow model with QASystem.export_weights (or
+InferenceEngine.export_weights), and then QASystem.load(path) is all that's needed to answer batches built by
+data_util.make_batch, so inference workers don't have to import TensorFlow.
+"""
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+import span_util
+from match_lstm_cell_np import dynamic_lstm, match_lstm, lstm_step, reverse_sequences, softmax, softmax_mask
+
+MATCH_LSTM_WEIGHTS = ['W_q', 'W_p', 'W_r', 'b_p', 'w_a', 'b_a', 'kernel', 'bias']
+
+
+def sub_weights(weights, prefix, names):
+    return dict((name, weights[prefix + '/' + name]) for name in names)
+
+
+class Encoder(object):
+    def __init__(self, weights, fused_bidirectional = False):
+        self.embeddings = weights['embeddings']
+        self.question_rnn = sub_weights(weights, 'question_rnn', ['kernel', 'bias'])
+        self.context_rnn = sub_weights(weights, 'context_rnn', ['kernel', 'bias'])
+
+        # The fused mode has one match LSTM for both directions
+        self.fused_bidirectional = fused_bidirectional
+        if self.fused_bidirectional:
+            self.match_lstm_fw = self.match_lstm_bw = sub_weights(weights, 'match_lstm', MATCH_LSTM_WEIGHTS)
+        else:
+            self.match_lstm_fw = sub_weights(weights, 'match_lstm_fw', MATCH_LSTM_WEIGHTS)
+            self.match_lstm_bw = sub_weights(weights, 'match_lstm_bw', MATCH_LSTM_WEIGHTS)
+
+    def encode_contexts(self, context_ids, context_lengths):
+        context_embeddings = self.embeddings[context_ids]                                                               # Dimensions = [Batch Size x P x E]
+        return dynamic_lstm(context_embeddings, context_lengths, **self.context_rnn)                                    # Dimensions = [Batch Size x P x L]
+
+    def encode(self, question_ids, question_lengths, context_ids, context_lengths, context_word_encodings = None):
+        """Returns the encodings of size [Batch Size x P x 2L], as Encoder.build.
+
+        The context LSTM outputs can be given as context_word_encodings (e.g. when they are cached for the
+        paragraph), then the context LSTM isn't run.
+        """
+        question_ids = np.asarray(question_ids)
+        context_ids = np.asarray(context_ids)
+
+        question_embeddings = self.embeddings[question_ids]                                                             # Dimensions = [Batch Size x Q x E]
+        question_word_encodings = dynamic_lstm(question_embeddings, question_lengths, **self.question_rnn)              # Dimensions = [Batch Size x Q x L]
+        if context_word_encodings is None:
+            context_word_encodings = self.encode_contexts(context_ids, context_lengths)
+
+        question_mask = softmax_mask(question_lengths, question_ids.shape[1], self.embeddings.dtype)
+        outputs_fw = match_lstm(context_word_encodings, context_lengths, question_word_encodings, question_mask,
+                                self.match_lstm_fw)
+        outputs_bw = reverse_sequences(match_lstm(reverse_sequences(context_word_encodings, context_lengths), context_lengths,
+                                                  question_word_encodings, question_mask, self.match_lstm_bw),
+                                       context_lengths)
+
+        return np.concatenate([outputs_fw, outputs_bw], axis = 2)
+
+
+
+class Decoder(object):
+    def __init__(self, weights, max_answer_length, boundary_model = False):
+        self.answer_pointer = sub_weights(weights, 'answer_pointer', ['V', 'W', 'b', 'v', 'c', 'kernel', 'bias'])
+        self.size = self.answer_pointer['W'].shape[0]
+        self.max_answer_length = max_answer_length
+        self.boundary_model = boundary_model
+        self.num_answer_steps = 2 if boundary_model else max_answer_length
+
+    def decode(self, encodings, encodings_lengths):
+        """Returns the answer softmaxes of size [Batch Size x answer steps x P (+ 1)], as Decoder.build."""
+        weights = self.answer_pointer
+        batch_size = encodings.shape[0]
+        encodings_lengths = np.asarray(encodings_lengths)
+        if not self.boundary_model:
+            # Add the zero vector to the encodings (for the end of answer token)
+            encodings = np.concatenate([encodings, np.zeros((batch_size, 1, 2 * self.size), dtype = encodings.dtype)], 1)
+            encodings_lengths = encodings_lengths + 1
+        encodings_mask = softmax_mask(encodings_lengths, encodings.shape[1], encodings.dtype)
+
+        encoding_projection = np.dot(encodings, weights['V'])                                                           # Dimensions = [Batch Size x (P + 1) x L]
+        input_kernel = weights['kernel'][:2 * self.size]
+        recurrent_kernel = weights['kernel'][2 * self.size:]
+        v = weights['v'][:, 0]
+
+        state = (np.zeros((batch_size, self.size), dtype = encodings.dtype), np.zeros((batch_size, self.size), dtype = encodings.dtype))
+        answer_softmaxes = []
+        for _ in xrange(self.num_answer_steps):
+            F_k = np.tanh(encoding_projection + (np.dot(state[1], weights['W']) + weights['b'])[:, None, :])             # Dimensions = [Batch Size x (P + 1) x L]
+            beta_k = softmax(np.dot(F_k, v) + weights['c'] + encodings_mask)                                             # Dimensions = [Batch Size x (P + 1)]
+            weighted_encodings = np.matmul(beta_k[:, None, :], encodings)[:, 0]                                         # Dimensions = [Batch Size x 2L]
+
+            state = lstm_step(np.dot(weighted_encodings, input_kernel), state, recurrent_kernel, weights['bias'])
+            answer_softmaxes.append(beta_k)
+
+        return np.stack(answer_softmaxes, axis = 1)
+
+
+
+class QASystem(object):
+    """Same interface as qa_model.QASystem for inference, without the sessions."""
+    def __init__(self, encoder, decoder, question_max_length, context_max_length):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.question_max_length = question_max_length
+        self.context_max_length = context_max_length
+        self.max_answer_length = decoder.max_answer_length
+
+    @classmethod
+    def load(cls, path):
+        """Loads the weights and the settings written by qa_model.QASystem.export_weights."""
+        with np.load(path) as data:
+            weights = dict((name, data[name]) for name in data.files)
+
+        encoder = Encoder(weights, fused_bidirectional = bool(weights['config/fused_bidirectional']))
+        decoder = Decoder(weights,
+                          max_answer_length = int(weights['config/max_answer_length']),
+                          boundary_model = bool(weights['config/boundary_model']))
+        return cls(encoder, decoder,
+                   question_max_length = int(weights['config/question_max_length']),
+                   context_max_length = int(weights['config/context_max_length']))
+
+    def encode(self, test_x):
+        return self.encoder.encode(test_x['question_ids'], test_x['question_lengths'],
+                                   test_x['context_ids'], test_x['context_lengths'],
+                                   test_x.get('context_word_encodings'))
+
+    def decode(self, test_x):
+        return self.decoder.decode(self.encode(test_x), test_x['context_lengths'])
+
+    def answer(self, test_x):
+        return span_util.answer_spans(self.decode(test_x), test_x['context_lengths'], self.max_answer_length,
+                                      self.decoder.boundary_model)
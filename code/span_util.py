@@ -0,0 +1,126 @@
+import numpy as np
+
+
+def find_best_spans(start_probabilities, end_probabilities, max_span_length, lengths = None):
+    """Finds the most likely answer span of every example in a batch.
+
+    For each example, picks the (s, e) that maximizes p_start[s] * p_end[e] subject to
+    s <= e < s + max_span_length (and e < length).  All the P x K candidate spans of the batch are
+    scored at once, so there is no python loop over the examples or the positions.
+
+    Args:
+        start_probabilities: array of size [Batch Size x P]
+        end_probabilities: array of size [Batch Size x P]
+        max_span_length: the maximum number of tokens (K) in a span
+        lengths: (optional) the number of valid tokens in each example, of size [Batch Size]
+    Returns:
+        a pair of arrays of size [Batch Size] with the start and the end indices of the spans.
+    """
+    start_probabilities = np.asarray(start_probabilities)
+    end_probabilities = np.asarray(end_probabilities)
+    batch_size, num_tokens = start_probabilities.shape
+
+    # span_ends[s, k] = s + k is the end of the span starting at s with k + 1 tokens
+    span_ends = np.arange(num_tokens)[:, None] + np.arange(max_span_length)[None, :]                  # Dimensions = [P x K]
+    if lengths is None:
+        valid_spans = np.broadcast_to(span_ends < num_tokens, (batch_size, num_tokens, max_span_length))
+    else:
+        valid_spans = span_ends[None, :, :] < np.asarray(lengths)[:, None, None]                      # Dimensions = [Batch Size x P x K]
+
+    span_end_probabilities = end_probabilities[:, np.minimum(span_ends, num_tokens - 1)]              # Dimensions = [Batch Size x P x K]
+    span_probabilities = np.where(valid_spans,
+                                  start_probabilities[:, :, None] * span_end_probabilities,
+                                  -1.0)
+
+    best_spans = np.argmax(span_probabilities.reshape(batch_size, -1), axis = 1)
+    starts = best_spans // max_span_length
+    ends = starts + best_spans % max_span_length
+    return starts, ends
+
+
+def answer_spans(answer_softmaxes, context_lengths, max_answer_length, boundary_model = False):
+    """Turns the answer pointer softmaxes of a batch into (starts, ends) spans.
+
+    For the boundary model, this is the best span of at most max_answer_length tokens (see find_best_spans).  For
+    the sequence model, it is the run of pointers up to the first end of answer token (index = context length).
+
+    Args:
+        answer_softmaxes: array of size [Batch Size x answer steps x P (+ 1)]
+        context_lengths: the lengths of the contexts, of size [Batch Size]
+    Returns:
+        a pair of arrays of size [Batch Size] with the start and the end indices of the spans.
+    """
+    context_lengths = np.asarray(context_lengths)
+
+    if boundary_model:
+        # Search all the spans of the batch at once, so that the end is never before the start
+        return find_best_spans(answer_softmaxes[:, 0, :], answer_softmaxes[:, 1, :], max_answer_length, context_lengths)
+
+    pointers = np.argmax(answer_softmaxes, axis = 2)
+    before_end = np.cumprod(pointers != context_lengths[:, None], axis = 1).astype(bool)
+
+    # The first pointer can be the end of answer token too, then the answer is the last context token
+    starts = np.minimum(pointers[:, 0], context_lengths - 1)
+    ends = np.max(np.where(before_end, pointers, starts[:, None]), axis = 1)
+
+    return starts, ends
+
+
+def span_scores(starts, ends, true_starts, true_ends):
+    """Token level exact match and F1 of the predicted spans, computed directly on the span indices.
+
+    The F1 counts the token positions shared by the predicted and the true span, so unlike the official metric it
+    doesn't need the answer strings (and doesn't normalize them), which makes it cheap enough to track on the
+    whole validation set.
+
+    Args:
+        starts, ends: the predicted spans (inclusive ends), arrays of size [Batch Size]
+        true_starts, true_ends: the true spans, arrays of size [Batch Size]
+    Returns:
+        the [Batch Size] arrays of the exact matches (booleans) and of the F1 scores.
+    """
+    starts, ends, true_starts, true_ends = [np.asarray(a) for a in (starts, ends, true_starts, true_ends)]
+    exact_match = (starts == true_starts) & (ends == true_ends)
+
+    num_same = np.maximum(np.minimum(ends, true_ends) - np.maximum(starts, true_starts) + 1, 0)
+    precision = num_same / np.maximum(ends - starts + 1, 1).astype(np.float64)
+    recall = num_same / np.maximum(true_ends - true_starts + 1, 1).astype(np.float64)
+    f1 = np.where(num_same > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-10), 0.0)
+    return exact_match, f1
+
+
+def do_find_best_spans_test():
+    np.random.seed(42)
+    batch_size = 4
+    num_tokens = 12
+    max_span_length = 3
+    start_probabilities = np.random.rand(batch_size, num_tokens)
+    end_probabilities = np.random.rand(batch_size, num_tokens)
+    lengths = np.array([12, 7, 1, 10])
+
+    starts, ends = find_best_spans(start_probabilities, end_probabilities, max_span_length, lengths)
+
+    for i in range(batch_size):
+        candidates = [(start_probabilities[i, s] * end_probabilities[i, e], s, e)
+                      for s in range(lengths[i]) for e in range(s, min(s + max_span_length, lengths[i]))]
+        _, expected_start, expected_end = max(candidates)
+        assert (starts[i], ends[i]) == (expected_start, expected_end), "span search should find the best valid span."
+
+    print("starts = " + str(starts))
+    print("ends = " + str(ends))
+
+
+def do_span_scores_test():
+    exact_match, f1 = span_scores([2, 0, 5, 3], [4, 1, 5, 3], [2, 3, 4, 3], [4, 5, 6, 4])
+
+    assert list(exact_match) == [True, False, False, False]
+    # 3 tokens out of 3 / no overlap / 1 of 1 predicted and 1 of 3 true / 1 of 1 predicted and 1 of 2 true
+    assert np.allclose(f1, [1.0, 0.0, 0.5, 2.0 / 3.0])
+
+    print("exact_match = " + str(exact_match))
+    print("f1 = " + str(f1))
+
+
+if __name__ == "__main__":
+    do_find_best_spans_test()
+    do_span_scores_test()
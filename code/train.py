@@ -4,6 +4,9 @@ import json
 import tensorflow as tf
 
 from qa_model import Encoder, QASystem, Decoder
+from parallel_train import DataParallelTrainer
+from checkpoint_manager import latest_checkpoint
+from data_util import MappedSequences
 from os.path import join as pjoin
 import numpy as np
 
@@ -15,6 +18,7 @@ tf.app.flags.DEFINE_float("learning_rate", 0.01, "Learning rate.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_integer("batch_size", 10, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("micro_batches", 1, "Number of batches of batch_size to accumulate the gradients of before each update (single process training only).")
 tf.app.flags.DEFINE_integer("epochs", 10, "Number of epochs to train.")
 #tf.app.flags.DEFINE_integer("state_size", 200, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("state_size", 10, "Size of each model layer.")
@@ -31,20 +35,26 @@ tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab
 tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
 tf.app.flags.DEFINE_integer("max_question_length", 20, "Max length of the questions")
 tf.app.flags.DEFINE_integer("max_context_length", 200, "Max length of the contexts")
+tf.app.flags.DEFINE_integer("max_answer_length", 15, "Max length of the answers")
+tf.app.flags.DEFINE_string("dtype", "float32", "Floating point type used by the model: float32 / float64")
+tf.app.flags.DEFINE_boolean("boundary_model", False, "Use the boundary model (only predict the answer start and end) instead of the sequence model")
+tf.app.flags.DEFINE_boolean("recompute_attention", False, "Recompute the match LSTM attention in the backward pass instead of keeping it for every step (less memory, more compute)")
+tf.app.flags.DEFINE_integer("num_workers", 1, "Number of processes computing the gradients of each batch in parallel (1 trains in this process)")
+tf.app.flags.DEFINE_boolean("fused_bidirectional", False, "Run both match LSTM directions as one recurrence with shared weights (not checkpoint compatible with the default)")
 
 FLAGS = tf.app.flags.FLAGS
 
 
 def initialize_model(session, model, train_dir):
-    ckpt = tf.train.get_checkpoint_state(train_dir)
-    v2_path = ckpt.model_checkpoint_path + ".index" if ckpt else ""
-    if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
-        logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+    checkpoint_path = latest_checkpoint(train_dir)
+    if checkpoint_path:
+        logging.info("Reading model parameters from %s" % checkpoint_path)
+        model.saver.restore(session, checkpoint_path)
     else:
         logging.info("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
-        logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
+        with model.graph.as_default():
+            session.run(tf.global_variables_initializer())
+            logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
 
@@ -60,59 +70,54 @@ def initialize_vocab(vocab_path):
         raise ValueError("Vocabulary file %s not found.", vocab_path)
 
 
-def get_normalized_train_dir(train_dir):
-    """
-    Adds symlink to {train_dir} from /tmp/cs224n-squad-train to canonicalize the
-    file paths saved in the checkpoint. This allows the model to be reloaded even
-    if the location of the checkpoint files has moved, allowing usage with CodaLab.
-    This must be done on both train.py and qa_answer.py in order to work.
+def load_dataset(data_dir, tier = 'train', drop_unreachable = True):
+    """Loads the question and context token ids and the answer spans of a tier.
+
+    The binary dataset written by qa_data.py is memory mapped when it exists, otherwise the token ids
+    files are parsed.  The sequences are kept unpadded.  data_util.bucketed_batches pads each batch to
+    its own longest sequence.  The examples whose answer ends after max_context_length, or is longer
+    than the decoder can point to, are dropped for training.  Otherwise they are kept, marked in the
+    'reachable' array, so that the evaluation counts them as misses.
     """
-    global_train_dir = '/tmp/cs224n-squad-train'
-    if os.path.exists(global_train_dir):
-        os.unlink(global_train_dir)
-    if not os.path.exists(train_dir):
-        os.makedirs(train_dir)
-    os.symlink(os.path.abspath(train_dir), global_train_dir)
-    return global_train_dir
-
-
-def load_dataset(data_dir):
-    train_ids_question_data_path = pjoin(FLAGS.data_dir, 'train.ids.question')
-    train_ids_context_data_path = pjoin(FLAGS.data_dir, 'train.ids.context')    
-
-    dataset = {}
-    if tf.gfile.Exists(train_ids_question_data_path):
-        train_question_ids = []
-        train_question_lengths = []
-        
-        with tf.gfile.GFile(train_ids_question_data_path, mode="rb") as f:
-            for line in f:
-                line_ids = map(int, line.strip('\n').split(' '))
-                line_length = len(line_ids)
-                padding_length = FLAGS.max_question_length - line_length
-                train_question_ids.append((line_ids + [0] * padding_length)[0:FLAGS.max_question_length])
-                question_seq_length = min(line_length, FLAGS.max_question_length)
-                train_question_lengths.append(question_seq_length)
-
-            dataset['train_question_ids'] = train_question_ids
-            dataset['train_question_lengths'] = train_question_lengths
-
-    if tf.gfile.Exists(train_ids_context_data_path):
-        train_context_ids = []
-        train_context_lengths = []
-        
-        with tf.gfile.GFile(train_ids_context_data_path, mode="rb") as f:
-            for line in f:
-                c_line_ids = map(int, line.strip('\n').split(' '))
-                c_line_length = len(c_line_ids)
-                c_padding_length = FLAGS.max_context_length - line_length
-                train_context_ids.append((c_line_ids + [0] * c_padding_length)[0:FLAGS.max_context_length])
-                context_seq_length = min(c_line_length, FLAGS.max_context_length)
-                train_context_lengths.append(context_seq_length)
-            
-            dataset['train_context_ids'] = train_context_ids
-            dataset['train_context_lengths'] = train_context_lengths
-            
+    question_path = pjoin(data_dir, tier + '.ids.question')
+    context_path = pjoin(data_dir, tier + '.ids.context')
+    span_path = pjoin(data_dir, tier + '.span')
+
+    def read_ids(path):
+        with tf.gfile.GFile(path, mode="rb") as f:
+            return [list(map(int, line.split())) for line in f]
+
+    if tf.gfile.Exists(context_path + '.tokens.npy'):
+        question_ids = MappedSequences.load(question_path)
+        context_ids = MappedSequences.load(context_path)
+        spans = np.load(span_path + '.npy', mmap_mode='r')
+    else:
+        question_ids = read_ids(question_path)
+        context_ids = read_ids(context_path)
+        spans = np.array(read_ids(span_path), dtype=np.int32).reshape(-1, 2)
+
+    # The sequence model needs one more step for the end of answer token
+    max_span_length = FLAGS.max_answer_length if FLAGS.boundary_model else FLAGS.max_answer_length - 1
+    reachable = (spans[:, 1] < FLAGS.max_context_length) & (spans[:, 1] - spans[:, 0] < max_span_length)
+    kept = np.flatnonzero(reachable)
+
+    if not drop_unreachable:
+        logging.info("Loaded %d %s examples (%d with unreachable answers, scored as misses)" %
+                     (len(spans), tier, len(spans) - len(kept)))
+        return {'question_ids': question_ids,
+                'context_ids': context_ids,
+                'spans': spans,
+                'reachable': reachable}
+
+    logging.info("Loaded %d %s examples (dropped %d with unreachable answers)" % (len(kept), tier, len(spans) - len(kept)))
+
+    if isinstance(context_ids, MappedSequences):
+        dataset = {'question_ids': question_ids.subset(kept),
+                   'context_ids': context_ids.subset(kept)}
+    else:
+        dataset = {'question_ids': [question_ids[i] for i in kept],
+                   'context_ids': [context_ids[i] for i in kept]}
+    dataset['spans'] = spans[kept]
     return dataset
 
 
@@ -121,23 +126,47 @@ def main(_):
     # Do what you need to load datasets from FLAGS.data_dir
     training_question_data_path = pjoin(FLAGS.data_dir, 'train.question')
     dataset = load_dataset(FLAGS.data_dir)
+    if tf.gfile.Exists(pjoin(FLAGS.data_dir, 'val.span')):
+        # All the examples, so that the validation scores aren't only measured on the answerable ones
+        val_dataset = load_dataset(FLAGS.data_dir, 'val', drop_unreachable = False)
+    else:
+        val_dataset = None
 
     embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
     vocab_path = FLAGS.vocab_path or pjoin(FLAGS.data_dir, "vocab.dat")
     vocab, rev_vocab = initialize_vocab(vocab_path)
 
     pretrained_embeddings = np.load(embed_path)['glove']
-    encoder = Encoder(size=FLAGS.state_size,
-                      vocab_dim=FLAGS.embedding_size,
-                      pretrained_embeddings = pretrained_embeddings,
-                      max_question_length = FLAGS.max_question_length,
-                      max_context_length = FLAGS.max_context_length)
-    decoder = Decoder(output_size=FLAGS.output_size,
-                      size = FLAGS.state_size,
-                      max_context_length = FLAGS.max_context_length)
 
-    qa = QASystem(encoder, decoder)
+    def build_model():
+        encoder = Encoder(size=FLAGS.state_size,
+                          pretrained_embeddings = pretrained_embeddings,
+                          max_question_length = FLAGS.max_question_length,
+                          max_context_length = FLAGS.max_context_length,
+                          fused_bidirectional = FLAGS.fused_bidirectional,
+                          recompute_attention = FLAGS.recompute_attention,
+                          dtype = tf.as_dtype(FLAGS.dtype))
+        decoder = Decoder(output_size=FLAGS.output_size,
+                          size = FLAGS.state_size,
+                          max_context_length = FLAGS.max_context_length,
+                          max_answer_length = FLAGS.max_answer_length,
+                          boundary_model = FLAGS.boundary_model,
+                          dtype = tf.as_dtype(FLAGS.dtype))
+
+        return QASystem(encoder, decoder,
+                        learning_rate = FLAGS.learning_rate,
+                        optimizer = FLAGS.optimizer,
+                        max_gradient_norm = FLAGS.max_gradient_norm)
+
+    # The workers are forked before this process starts its session
+    if FLAGS.num_workers > 1:
+        with DataParallelTrainer(build_model, dataset, FLAGS.num_workers, FLAGS.batch_size) as parallel_trainer:
+            train_model(build_model(), dataset, val_dataset, rev_vocab, parallel_trainer)
+    else:
+        train_model(build_model(), dataset, val_dataset, rev_vocab)
+
 
+def train_model(qa, dataset, val_dataset, rev_vocab, parallel_trainer = None):
     if not os.path.exists(FLAGS.log_dir):
         os.makedirs(FLAGS.log_dir)
     file_handler = logging.FileHandler(pjoin(FLAGS.log_dir, "log.txt"))
@@ -147,14 +176,23 @@ def main(_):
     with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
         json.dump(FLAGS.__flags, fout)
 
-    with tf.Session() as sess:
-        load_train_dir = get_normalized_train_dir(FLAGS.load_train_dir or FLAGS.train_dir)
-        initialize_model(sess, qa, load_train_dir)
-
-        save_train_dir = get_normalized_train_dir(FLAGS.train_dir)
-        qa.train(sess, dataset, save_train_dir)
-
-        qa.evaluate_answer(sess, dataset, vocab, FLAGS.evaluate, log=True)
+    with tf.Session(graph = qa.graph) as sess:
+        # The checkpoint paths are relative to their directory, so they can be loaded after it's moved
+        initialize_model(sess, qa, FLAGS.load_train_dir or FLAGS.train_dir)
+
+        qa.train(sess, dataset, FLAGS.train_dir,
+                 epochs = FLAGS.epochs,
+                 batch_size = FLAGS.batch_size,
+                 print_every = FLAGS.print_every,
+                 eval_dataset = val_dataset,
+                 parallel_trainer = parallel_trainer,
+                 keep = FLAGS.keep,
+                 num_micro_batches = FLAGS.micro_batches)
+
+        # The string metrics on the words of the token spans, only once at the end.  These are not the official
+        # metrics (the words are rebuilt from the ids, UNKs included), run qa_answer.py and evaluate.py for those.
+        f1, em = qa.evaluate_answer(sess, val_dataset or dataset, rev_vocab=rev_vocab)
+        logging.info("Token words F1: {}, EM: {}".format(f1, em))
 
 if __name__ == "__main__":
     tf.app.run()
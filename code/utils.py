@@ -1,14 +1,80 @@
 import tensorflow as tf
 import numpy as np
 
-def create_softmax_mask(batch_seq_lengths, max_seq_length):
-    seq_length_transposed = tf.expand_dims(batch_seq_lengths, 1)
-    range = tf.range(0, max_seq_length)
-    range_row = tf.expand_dims(range, 0)
-    
-    softmax_mask_condition = tf.less(seq_length_transposed, range_row)
-    softmax_mask = tf.where(softmax_mask_condition,
-                            tf.fill(tf.shape(softmax_mask_condition), value=np.float64(-np.inf)),
-                            tf.fill(tf.shape(softmax_mask_condition), value=np.float64(0)))
-    return softmax_mask
+# Added to the masked logits before a softmax.  It is finite so that a row where every position is masked
+# gives a uniform softmax instead of NaNs.
+MASK_VALUE = -1e30
 
+
+def _get_or_build_mask(key, build):
+    # The masks of a graph, by (kind, lengths tensor, max length, dtype), are stored on the graph itself, so that
+    # they are freed with it
+    graph = tf.get_default_graph()
+    if not hasattr(graph, '_softmax_masks'):
+        graph._softmax_masks = {}
+    graph_masks = graph._softmax_masks
+    if key not in graph_masks:
+        graph_masks[key] = build()
+    return graph_masks[key]
+
+
+def create_sequence_mask(batch_seq_lengths, max_seq_length):
+    """Returns the [Batch Size x max_seq_length] boolean mask of the positions that are not masked, the ones up
+    to the sequence lengths.
+
+    The mask is built once per graph for the same lengths tensor and max length, and then shared by all the
+    callers (so they must not be inside a while loop).
+    """
+    def build():
+        positions = tf.expand_dims(tf.range(0, max_seq_length), 0)
+        return tf.less_equal(positions, tf.expand_dims(batch_seq_lengths, 1))
+
+    return _get_or_build_mask(('sequence', batch_seq_lengths, max_seq_length), build)
+
+
+def create_softmax_mask(batch_seq_lengths, max_seq_length, dtype = tf.float32):
+    """Returns the additive softmax mask (0 where create_sequence_mask is True, MASK_VALUE elsewhere), shared in
+    the same way."""
+    def build():
+        masked = tf.logical_not(create_sequence_mask(batch_seq_lengths, max_seq_length))
+        return tf.cast(masked, dtype) * dtype.as_numpy_dtype(MASK_VALUE)
+
+    return _get_or_build_mask(('softmax', batch_seq_lengths, max_seq_length, dtype), build)
+
+
+def do_create_softmax_mask_test():
+    with tf.Graph().as_default():
+        lengths = tf.placeholder(tf.int32, shape = (None,))
+        max_length = tf.shape(lengths)[0]
+        softmax_mask = create_softmax_mask(lengths, max_length)
+        assert create_softmax_mask(lengths, max_length) is softmax_mask, "the mask should be shared."
+
+        # The second row is masked everywhere
+        logits = tf.zeros_like(softmax_mask)
+        softmax = tf.nn.softmax(logits + softmax_mask)
+        with tf.Session() as sess:
+            mask_value, softmax_value = sess.run([softmax_mask, softmax], feed_dict = {lengths: [1, -1, 2]})
+
+    assert np.array_equal(mask_value, np.array([[0, 0, MASK_VALUE], [MASK_VALUE] * 3, [0, 0, 0]], dtype = np.float32))
+    assert not np.any(np.isnan(softmax_value)), "a fully masked row shouldn't give NaNs."
+    print("softmax = " + str(softmax_value))
+
+
+def do_mask_cache_release_test():
+    import gc
+    import weakref
+
+    graph = tf.Graph()
+    with graph.as_default():
+        lengths = tf.placeholder(tf.int32, shape = (None,))
+        create_softmax_mask(lengths, tf.shape(lengths)[0])
+    graph_ref = weakref.ref(graph)
+
+    del graph, lengths
+    gc.collect()
+    assert graph_ref() is None, "the masks shouldn't keep their graph alive."
+
+
+if __name__ == "__main__":
+    do_create_softmax_mask_test()
+    do_mask_cache_release_test()